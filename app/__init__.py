@@ -1,47 +1,135 @@
 import logging
 from flask import Flask
+from werkzeug.local import LocalProxy
 from config import Config
-from flask_migrate import Migrate
-from flask_login import LoginManager
-from flask_bootstrap import Bootstrap
-from flask_pymongo import PyMongo
+from app.database import MongoConnection
+from app.schemas import SchemaRegistry
+from app.indexes import ensure_indexes
+from app.cache import DocumentCache
+from app.cascade import CascadeWorker, PULL
+from app.admission import AdmissionController
+from app.singleflight import SingleFlight
+from app.batching import WriteBatcher
+from app.logs import LogPipeline, JsonFormatter
+from app.profiling import RequestProfiler, SlowRequestLog
+from app import metrics, compression
+from app.stats import stats_cli, record_created, record_pulled
 from logging.handlers import RotatingFileHandler
-from pandas_datareader import data as pdr
 import os
 
-app = Flask(__name__)
-app.config.from_object(Config)
-mongodb_client = PyMongo(app)
-db = mongodb_client.db
+slow_request_log = SlowRequestLog()
+mongo = MongoConnection(event_listeners=[metrics.CommandListener(), metrics.PoolListener(), slow_request_log])
+# Resolved on every use, so each worker process talks to MongoDB through its own client
+db = LocalProxy(lambda: mongo.db)
 
+schema_registry = SchemaRegistry()
+document_cache = DocumentCache()
+metrics.registry.add_collector(metrics.cache_collector(document_cache))
 
-login = LoginManager(app)
-login.login_view = 'login'
-login.login_message = 'Por favor ingresa tus credenciales para acceder'
-bootstrap = Bootstrap(app)
 
-if not app.debug:
-    """ Configuración de los logs, accesibles por medio del comando heroku logs --tail
+def cascade_cleaned(collection, field: str, action: str, previous: list):
+    """Called by the cascade worker after every batch: drops the updated documents from
+    the cache and, when a reference was $pulled from a list, updates its size stats
+    from the pre-images of the documents"""
+    for document in previous:
+        document_cache.invalidate(collection.name, str(document["_id"]))
+    if action == PULL:
+        record_pulled(db, collection.name, field, [document["size"] for document in previous])
+
+
+cascade_worker = CascadeWorker(on_batch=cascade_cleaned)
+admission_controller = AdmissionController()
+read_coalescer = SingleFlight()
+metrics.registry.add_collector(metrics.singleflight_collector(read_coalescer))
+write_batcher = WriteBatcher(on_created=lambda collection, documents: record_created(db, collection.name, documents))
+metrics.registry.add_collector(metrics.write_batcher_collector(write_batcher))
+metrics.registry.add_collector(admission_controller.collect)
+request_profiler = RequestProfiler()
+log_pipeline = LogPipeline()
+metrics.registry.add_collector(metrics.log_pipeline_collector(log_pipeline))
+
+# The pids of the processes that already warmed up
+warmed_up = set()
+
+
+def create_app(config_class=Config):
+    """Builds the Flask app. Nothing here opens a connection or starts a thread, so the
+    app can be created in a gunicorn --preload master and then forked.
+
+    :param config_class: The object to take the settings from
+    :return: The configured app
+    :rtype: Flask
     """
-    if app.config['LOG_TO_STDOUT']:
-        stream_handler = logging.StreamHandler()
-        stream_handler.setLevel(logging.INFO)
-        app.logger.addHandler(stream_handler)
-    else:
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
-        file_handler = RotatingFileHandler('logs/mulan.log',
-                                           maxBytes=10240, backupCount=10)
-        file_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s '
-            '[in %(pathname)s:%(lineno)d]'))
-        file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+
+    mongo.init_app(app)
+    document_cache.init_app(app)
+    cascade_worker.init_app(app)
+    read_coalescer.init_app(app)
+    write_batcher.init_app(app)
+    schema_registry.auto_reload = bool(app.config['SCHEMA_AUTO_RELOAD'] or app.debug)
+    schema_registry.preload()
+
+    # First, so the requests rejected by admission control still get a request id and a log line
+    init_logging(app)
+    app.before_request(metrics.start_request_timer)
+    admission_controller.init_app(app)
+    request_profiler.init_app(app)
+    slow_request_log.init_app(app, mongo)
+    app.after_request(metrics.record_request)
+    # Runs after add_conditional_headers, so the ETag is the hash of the plain body
+    app.after_request(compression.compress_response)
+    app.before_first_request(warm_up)
+
+    app.cli.add_command(stats_cli)
+    init_extensions(app)
+
+    from app import routes, errors
+    app.register_blueprint(routes.bp)
+    return app
+
+
+def warm_up():
+    """Opens the connection pool, creates the indexes and takes over the abandoned
+    cascade jobs. It runs in every process from the post_worker_init hook of
+    gunicorn.conf.py, and otherwise on the first request"""
+    if os.getpid() in warmed_up:
+        return
+    warmed_up.add(os.getpid())
+    ensure_indexes(db)
+    cascade_worker.resume(db)
 
-    app.logger.setLevel(logging.INFO)
-    app.logger.info('Microblog startup')
 
+def init_extensions(app):
+    """Loads the extensions listed in OPTIONAL_EXTENSIONS. They are imported here, since
+    the JSON API does not need them and importing them slows down the start"""
+    extensions = app.config['OPTIONAL_EXTENSIONS']
+    if 'login' in extensions:
+        from flask_login import LoginManager
+        login = LoginManager(app)
+        login.login_view = 'login'
+        login.login_message = 'Por favor ingresa tus credenciales para acceder'
+    if 'bootstrap' in extensions:
+        from flask_bootstrap import Bootstrap
+        Bootstrap(app)
 
 
+def init_logging(app):
+    if not app.debug:
+        """ Configuración de los logs, accesibles por medio del comando heroku logs --tail.
+        Los requests solo encolan los registros; un hilo aparte los escribe como JSON
+        """
+        if app.config['LOG_TO_STDOUT']:
+            handler = logging.StreamHandler()
+        else:
+            if not os.path.exists('logs'):
+                os.mkdir('logs')
+            handler = RotatingFileHandler('logs/mulan.log', maxBytes=app.config['LOG_MAX_BYTES'],
+                                          backupCount=app.config['LOG_BACKUP_COUNT'])
+        handler.setFormatter(JsonFormatter())
+        handler.setLevel(logging.INFO)
+        log_pipeline.init_app(app, [handler])
 
-from app import routes, errors
\ No newline at end of file
+        app.logger.setLevel(logging.INFO)
+        app.logger.info('Microblog startup')
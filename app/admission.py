@@ -0,0 +1,193 @@
+"""Admission control of the Flask app.
+
+Each request that reaches MongoDB belongs to a class (reads, writes or bulk) with its
+own concurrency limit. When a class is full, a few requests may wait for a short time;
+the rest are rejected right away with 503 and Retry-After, so a slow MongoDB does not
+pile up requests until the workers time out. On top of that every client has a token
+bucket, and requests without a token get 429.
+
+The limits and buckets belong to the worker process, like the document cache.
+"""
+import math
+import time
+import threading
+from collections import OrderedDict
+
+from flask import current_app, make_response, request
+
+from app.metrics import Counter, Gauge
+
+READS = "reads"
+WRITES = "writes"
+BULK = "bulk"
+
+
+class ConcurrencyLimiter(object):
+    """Lets at most limit requests run at once. Up to max_waiting more wait at most
+    timeout seconds for a slot; past that, acquire fails immediately"""
+
+    def __init__(self, limit: int, max_waiting: int = 0, timeout: float = 0):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Takes a slot
+
+        :return: None if the slot was taken, otherwise why it was not: queue_full or timeout
+        :rtype: str
+        """
+        with self._condition:
+            if self.in_flight < self.limit:
+                self.in_flight += 1
+                return None
+            if self.waiting >= self.max_waiting:
+                return "queue_full"
+            self.waiting += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self.in_flight >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return "timeout"
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            return None
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+
+class TokenBucketLimiter(object):
+    """One token bucket per client, refilled at rate tokens per second up to burst.
+    Only the max_clients most recently seen clients are remembered"""
+
+    def __init__(self, rate: float, burst: int, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client: str):
+        """Takes a token of the client
+
+        :return: 0 if there was a token, otherwise the seconds until the next one
+        :rtype: float
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+def exempt(view):
+    """Decorator for the views that never touch MongoDB, e.g. /metrics, so they still
+    answer when the service is saturated"""
+    view.admission_exempt = True
+    return view
+
+
+def request_class(rule: str, method: str):
+    if rule.endswith("/bulk"):
+        return BULK
+    if rule.endswith("/_mget") or method in ("GET", "HEAD", "OPTIONS"):
+        return READS
+    return WRITES
+
+
+class AdmissionController(object):
+
+    def __init__(self):
+        self.limiters = {}
+        self.rate_limiter = None
+        self.rejections = Counter("admission_rejections_total", "Requests rejected by admission control",
+                                  ("class", "reason"))
+
+    def init_app(self, app):
+        """Builds the limiters from the ADMISSION_* and RATE_LIMIT_* settings and adds the
+        request hooks. A limit of 0 turns it off"""
+        max_waiting = app.config['ADMISSION_MAX_WAITING']
+        timeout = app.config['ADMISSION_WAIT_TIMEOUT']
+        self.limiters = {}
+        for name, setting in ((READS, 'ADMISSION_READS'), (WRITES, 'ADMISSION_WRITES'), (BULK, 'ADMISSION_BULK')):
+            if app.config[setting]:
+                self.limiters[name] = ConcurrencyLimiter(app.config[setting], max_waiting, timeout)
+        self.rate_limiter = None
+        if app.config['RATE_LIMIT']:
+            self.rate_limiter = TokenBucketLimiter(app.config['RATE_LIMIT'], app.config['RATE_LIMIT_BURST'])
+        app.before_request(self.admit)
+        app.after_request(self.release_on_close)
+        app.teardown_request(self.release)
+
+    def client_key(self):
+        header = current_app.config['RATE_LIMIT_HEADER']
+        if header and request.headers.get(header):
+            return request.headers[header]
+        return request.remote_addr or ""
+
+    def reject(self, status: int, message: str, retry_after: float):
+        return make_response({"msg":message}, status, {"Content-Type": "application/json",
+                                                       "Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    def admit(self):
+        """before_request hook. Returns the 429/503 response of a rejected request"""
+        view = current_app.view_functions.get(request.endpoint)
+        if request.url_rule is None or getattr(view, "admission_exempt", False):
+            return None
+        name = request_class(request.url_rule.rule, request.method)
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.take(self.client_key())
+            if wait:
+                self.rejections.inc(name, "rate_limit")
+                return self.reject(429, "Demasiadas solicitudes. Intente más tarde", wait)
+        limiter = self.limiters.get(name)
+        if limiter is None:
+            return None
+        reason = limiter.acquire()
+        if reason:
+            self.rejections.inc(name, reason)
+            return self.reject(503, "Servicio saturado. Intente más tarde", current_app.config['ADMISSION_RETRY_AFTER'])
+        request.environ["admission.limiter"] = limiter
+        return None
+
+    def release_on_close(self, response):
+        """after_request hook. The slot is given back when the server closes the
+        response, so a streamed response keeps it until its last chunk is sent"""
+        limiter = request.environ.pop("admission.limiter", None)
+        if limiter is not None:
+            response.call_on_close(limiter.release)
+        return response
+
+    def release(self, error=None):
+        """teardown_request hook, so the slot is given back even if no response was
+        made, e.g. when an after_request hook failed"""
+        limiter = request.environ.pop("admission.limiter", None)
+        if limiter is not None:
+            limiter.release()
+
+    def collect(self):
+        """Collector of the metrics registry: the rejections, and the requests running
+        and waiting in every class"""
+        in_flight = Gauge("admission_in_flight_requests", "Requests running, by class", ("class",))
+        waiting = Gauge("admission_waiting_requests", "Requests waiting for a slot, by class", ("class",))
+        for name, limiter in sorted(self.limiters.items()):
+            in_flight.set(name, value=limiter.in_flight)
+            waiting.set(name, value=limiter.waiting)
+        return [self.rejections, in_flight, waiting]
@@ -0,0 +1,602 @@
+"""Async serving mode of the CRUD API.
+
+The same routes of app/routes.py for the wines, restaurants, clients and their
+relationships, written as async handlers on the Motor driver so one process can keep
+hundreds of requests waiting on MongoDB at the same time. It runs under any ASGI server:
+
+    $ uvicorn asgi:app
+
+The responses are the same ones returned by the Flask app.
+"""
+import logging
+
+from quart import Quart, request, Response
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from bson.objectid import ObjectId
+from werkzeug.http import generate_etag
+
+from config import Config
+from app.schemas import SchemaRegistry, COLLECTION_SCHEMAS
+from app.cache import DocumentCache
+from app.cascade import CascadeWorker, PULL, CLEAR, job_status
+from app.indexes import INDEXES
+from app import encoder, compression, stats
+from app.core import (headers, EXPANDABLE_FIELDS, InvalidRequest, make_message, document_entry, parse_expand,
+                      collection_fields, reference_fields, expanded_pipeline, merge_expanded, references_body,
+                      plan_listing, ndjson_line, page_body, split_ids, parse_ids, mget_query, mget_results,
+                      get_reference_ids, references_query, missing_references, reference_projection)
+
+app = Quart(__name__)
+app.config.from_object(Config)
+
+schema_registry = SchemaRegistry(auto_reload=app.config['SCHEMA_AUTO_RELOAD'])
+schema_registry.preload()
+document_cache = DocumentCache(app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_TTL'])
+cascade_worker = CascadeWorker(app.config['CASCADE_WORKERS'], app.config['CASCADE_BATCH_SIZE'],
+                               app.config['CASCADE_MAX_RETRIES'], app.config['CASCADE_JOB_LEASE'],
+                               app.config['CASCADE_JOB_TTL'], on_batch=lambda *batch: cascade_cleaned(*batch))
+
+# Set when the server starts, inside its event loop
+db = None
+# The cascade worker runs on threads, so it uses a regular PyMongo client
+sync_db = None
+
+
+@app.before_serving
+async def connect():
+    global db, sync_db
+    db = AsyncIOMotorClient(app.config['MONGO_URI']).get_default_database()
+    sync_db = MongoClient(app.config['MONGO_URI']).get_default_database()
+    for collection, indexes in INDEXES.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except Exception as err:
+            logging.error("Could not create the indexes of the %s collection: %s", collection, err)
+    cascade_worker.resume(sync_db)
+
+
+def validate_json(dict_data: dict, schema_name: str):
+    return schema_registry.is_valid(dict_data, schema_name)
+
+
+def cascade_cleaned(collection, field: str, action: str, previous: list):
+    for document in previous:
+        document_cache.invalidate(collection.name, str(document["_id"]))
+    if action == PULL:
+        stats.record_pulled(sync_db, collection.name, field, [document["size"] for document in previous])
+
+
+async def record_stats(collection_name: str, before: dict = None, after: dict = None):
+    await apply_stats(collection_name, stats.changes(collection_name, before, after))
+
+
+async def apply_stats(collection_name: str, delta):
+    operations = stats.updates(collection_name, delta)
+    if not operations:
+        return
+    try:
+        await db.stats.bulk_write(operations, ordered=False)
+    except PyMongoError as err:
+        logging.error("Could not update the stats of the %s collection: %s", collection_name, err)
+
+
+async def add_references(collection, id: str, field: str, reference_ids: list):
+    """Async version of app.routes.add_references"""
+    object_id = ObjectId(id)
+    reference_ids = list(dict.fromkeys(reference_ids))
+    previous = await collection.find_one_and_update({"_id": object_id},
+                                                    {"$addToSet": {field: {"$each": reference_ids}}},
+                                                    reference_projection(field, reference_ids),
+                                                    return_document=ReturnDocument.BEFORE)
+    document_cache.invalidate(collection.name, str(object_id))
+    if previous is None:
+        return None
+    added = len(reference_ids) - len(previous["held"])
+    if added:
+        await apply_stats(collection.name, stats.resize_changes(field, [previous["size"]], added))
+    return added
+
+
+async def remove_reference(collection, id: str, field: str, reference_id: str):
+    """Async version of app.routes.remove_reference"""
+    object_id = ObjectId(id)
+    previous = await collection.find_one_and_update({"_id": object_id}, {"$pull": {field: reference_id}},
+                                                    reference_projection(field, [reference_id]),
+                                                    return_document=ReturnDocument.BEFORE)
+    document_cache.invalidate(collection.name, str(object_id))
+    if previous is None:
+        return None
+    removed = len(previous["held"])
+    if removed:
+        await apply_stats(collection.name, stats.resize_changes(field, [previous["size"]], -removed))
+    return removed
+
+
+def get_schema(collection_name: str):
+    return schema_registry.get(COLLECTION_SCHEMAS[collection_name]).schema
+
+
+def get_fields(collection_name: str):
+    return collection_fields(request.args.get("fields"), collection_name, get_schema(collection_name))
+
+
+def get_reference_fields(collection_name: str, field: str):
+    return reference_fields(request.args, collection_name, field,
+                            get_schema(EXPANDABLE_FIELDS[collection_name][field]))
+
+
+def wants_ndjson():
+    if request.args.get("stream") in ("1", "true"):
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+
+async def find_missing(collection, reference_ids: list):
+    cursor = collection.find(references_query(reference_ids), {"_id": 1})
+    return missing_references(reference_ids, await cursor.to_list(None))
+
+
+async def find_expanded(collection, id: str, field: str, projection: dict = None):
+    async for document in collection.aggregate(expanded_pipeline(collection.name, id, field, projection)):
+        return merge_expanded(document, field)
+    return None
+
+
+async def get_document_body(collection, id: str, projection: dict = None):
+    object_id = ObjectId(id)
+    if projection:
+        document = await collection.find_one({"_id": object_id}, projection)
+        return document_entry(document) if document else None
+    entry = document_cache.get(collection.name, str(object_id))
+    if entry is None:
+        generation = document_cache.generation(collection.name, str(object_id))
+        document = await collection.find_one({"_id": object_id})
+        if not document:
+            return None
+        entry = document_entry(document)
+        document_cache.set(collection.name, str(object_id), entry, generation)
+    return entry
+
+
+async def get_references_body(collection, id: str, field: str, projection: dict = None):
+    if parse_expand(request.args.get("expand"), collection.name) == field:
+        document = await find_expanded(collection, id, field, projection)
+    else:
+        document = await collection.find_one({"_id": ObjectId(id)}, {field: 1})
+    return references_body(document, field) if document else None
+
+
+async def multi_get(collection):
+    if request.method == "GET":
+        ids = split_ids(request.args.get("ids"))
+    else:
+        body = await request.get_json(silent=True)
+        ids = body.get("ids") if isinstance(body, dict) else body
+    try:
+        requested = parse_ids(ids, app.config["MGET_MAX_IDS"])
+        projection = get_fields(collection.name)
+    except InvalidRequest as err:
+        return make_message(str(err)), 400, headers
+    query = mget_query(requested)
+    documents = await collection.find(query, projection).to_list(None) if query else []
+    return encoder.dumps({"body":mget_results(requested, documents)}), 200, headers
+
+
+async def list_documents(collection):
+    if "ids" in request.args:
+        return await multi_get(collection)
+    streaming = wants_ndjson()
+    try:
+        plan = plan_listing(collection.name, request.args, get_schema(collection.name), streaming,
+                            app.config["DEFAULT_PAGE_SIZE"], app.config["MAX_PAGE_SIZE"])
+    except InvalidRequest as err:
+        return make_message(str(err)), 400, headers
+    if plan["pipeline"] is not None:
+        cursor = collection.aggregate(plan["pipeline"], batchSize=app.config["STREAM_BATCH_SIZE"])
+    else:
+        cursor = collection.find(plan["query"], plan["projection"]).sort("_id", ASCENDING) \
+            .batch_size(app.config["STREAM_BATCH_SIZE"])
+        if plan["limit"]:
+            cursor = cursor.limit(plan["limit"])
+    if streaming:
+        async def stream_documents():
+            async for document in cursor:
+                yield ndjson_line(document, plan)
+        return Response(stream_documents(), 200, mimetype="application/x-ndjson")
+    return page_body(await cursor.to_list(None), plan), 200, headers
+
+
+@app.after_request
+async def add_conditional_headers(response):
+    if request.method not in ("GET", "HEAD") or response.status_code != 200:
+        return response
+    if response.mimetype == "application/x-ndjson":
+        return response
+    if not response.get_etag()[0]:
+        response.set_etag(generate_etag(await response.get_data(as_text=False)))
+    response.headers.setdefault("Cache-Control", app.config["CACHE_CONTROL"])
+    if request.if_none_match.contains_weak(response.get_etag()[0]):
+        not_modified = Response("", 304)
+        not_modified.set_etag(response.get_etag()[0])
+        not_modified.headers["Cache-Control"] = response.headers["Cache-Control"]
+        return not_modified
+    return await compress_response(response)
+
+
+async def compress_response(response):
+    """Compresses the JSON reads as the Flask app does. The NDJSON streams never get here"""
+    if not compression.is_compressible(response):
+        return response
+    encoding = compression.choose_encoding(request.accept_encodings)
+    data = await response.get_data(as_text=False)
+    if encoding is None or len(data) < app.config["COMPRESS_MIN_SIZE"]:
+        return response
+    response.set_data(compression.compress(data, encoding, app.config["COMPRESS_LEVEL"]))
+    compression.mark_encoded(response, encoding)
+    return response
+
+
+@app.errorhandler(404)
+async def not_found_error(error):
+    return {"msg":'Recurso no encontrado'}, 404, headers
+
+
+@app.errorhandler(405)
+async def method_not_allowed(error):
+    return {"msg":"Metodo no soportado"}, 405, headers
+
+
+@app.errorhandler(400)
+async def bad_request(error):
+    return {"msg":"Solicitud inválida"}, 405, headers
+
+
+@app.errorhandler(500)
+async def internal_error(error):
+    return {"msg":"Error de servidor"}, 500, headers
+
+
+@app.route("/cache/stats", methods=["GET"])
+async def cache_stats():
+    return {"body":document_cache.stats()}, 200, headers
+
+
+@app.route("/jobs/<string:job_id>", methods=["GET"])
+async def cascade_job(job_id: str):
+    job = await db.jobs.find_one({"_id": job_id})
+    if job:
+        return {"body":job_status(job)}, 200, headers
+    return make_message("Tarea no encontrada"), 404, headers
+
+
+@app.route("/stats", methods=["GET"])
+async def list_stats():
+    available = ["{}/{}".format(collection_name, field)
+                 for collection_name, fields in stats.ROLLUPS.items() for field in fields]
+    return {"body":available}, 200, headers
+
+
+@app.route("/stats/<string:collection_name>/<string:field>", methods=["GET"])
+async def read_stats(collection_name: str, field: str):
+    if field not in stats.ROLLUPS.get(collection_name, {}):
+        return make_message("Estadística no encontrada"), 404, headers
+    cursor = db.stats.find({"collection": collection_name, "field": field, "count": {"$gt": 0}},
+                           {"_id": 0, "key": 1, "count": 1}).sort("key")
+    groups = [group async for group in cursor]
+    total = sum(group["count"] for group in groups)
+    return encoder.dumps({"body":groups, "total":total}), 200, headers
+
+
+@app.route("/", methods=["GET", "POST"])
+@app.route("/index", methods=["GET", "POST"])
+async def index():
+    return "Hola mundo"
+
+
+@app.route("/wines", methods=["GET", "POST"])
+async def read_create_wines():
+    if request.method == "GET":
+        return await list_documents(db.wines)
+    dict_data = await request.get_json()
+    if validate_json(dict_data, "wine.json"):
+        try:
+            await db.wines.insert_one(dict_data)
+        except DuplicateKeyError:
+            logging.warning("Attempted to write duplicated registry in wines collection")
+            return make_message("Registro duplicado"), 409, headers
+        await record_stats("wines", after=dict_data)
+        return make_message("Agregado exitosamente"), 200, headers
+    return make_message("Parámetros inválidos o faltantes"), 400, headers
+
+
+@app.route("/wines/_mget", methods=["POST"])
+async def mget_wines():
+    return await multi_get(db.wines)
+
+
+@app.route("/wines/<string:id>", methods=["GET","PUT","PATCH","DELETE"])
+async def update_delete_wines(id: str):
+    if request.method == "GET":
+        try:
+            projection = get_fields("wines")
+        except InvalidRequest as err:
+            return make_message(str(err)), 400, headers
+        try:
+            entry = await get_document_body(db.wines, id, projection)
+            if entry:
+                response = Response(entry[0], 200, headers)
+                response.set_etag(entry[1])
+                return response
+            return make_message("Recurso no encontrado"), 404, headers
+        except:
+            return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+    elif request.method in ("PUT","PATCH"):
+        try:
+            dict_data = await request.get_json()
+            if validate_json(dict_data, "wine.json"):
+                previous = await db.wines.find_one_and_replace({"_id": ObjectId(id)},dict_data)
+                document_cache.invalidate("wines", str(ObjectId(id)))
+                if previous:
+                    await record_stats("wines", previous, dict_data)
+                    return make_message("Exitosamente actualizado"), 200, headers
+                return make_message("Vino no encontrado. Nada que actualizar"), 404, headers
+            return make_message("Parámetros inválidos o faltantes"), 400, headers
+        except DuplicateKeyError:
+            return make_message("Conflcito entre registros. Otro vino ya tiene ese nombre"), 409, headers
+        except:
+            return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+    try:
+        previous = await db.wines.find_one_and_delete({"_id": ObjectId(id)})
+        document_cache.invalidate("wines", str(ObjectId(id)))
+        if previous:
+            await record_stats("wines", before=previous)
+            wine_id = str(ObjectId(id))
+            job_id = await cascade_worker.enqueue_async(db.jobs, sync_db.restaurants, "wines", wine_id)
+            return dict(make_message("Exitosamente eliminado"), job=job_id), 200, headers
+        return make_message("No se hallo el vino. Nada que eliminar"), 404, headers
+    except:
+        return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+
+
+@app.route("/restaurants", methods=["GET", "POST"])
+async def read_create_restaurants():
+    if request.method == "GET":
+        return await list_documents(db.restaurants)
+    dict_data = await request.get_json()
+    if validate_json(dict_data, "restaurant.json"):
+        dict_data["wines"]=[]
+        if dict_data.get("manager_id"):
+            try:
+                manager = await db.clients.find_one({"_id":ObjectId(dict_data["manager_id"])})
+            except:
+                return make_message("Parametros invalidos o faltantes"), 400, headers
+            if not manager:
+                return make_message("The manager doesn't exist"), 400, headers
+        else:
+            dict_data["manager_id"]=""
+        try:
+            await db.restaurants.insert_one(dict_data)
+        except DuplicateKeyError:
+            logging.warning("Attempted to write duplicated registry in restaurants collection")
+            return make_message("Registro duplicado"), 409, headers
+        await record_stats("restaurants", after=dict_data)
+        return make_message("Agregado exitosamente"), 200, headers
+    return make_message("Parámetros inválidos o faltantes"), 400, headers
+
+
+@app.route("/restaurants/_mget", methods=["POST"])
+async def mget_restaurants():
+    return await multi_get(db.restaurants)
+
+
+@app.route("/restaurants/<string:id>", methods=["GET","PUT","PATCH","DELETE"])
+async def update_delete_restaurants(id: str):
+    if request.method == "GET":
+        try:
+            projection = get_fields("restaurants")
+        except InvalidRequest as err:
+            return make_message(str(err)), 400, headers
+        try:
+            entry = await get_document_body(db.restaurants, id, projection)
+            if entry:
+                response = Response(entry[0], 200, headers)
+                response.set_etag(entry[1])
+                return response
+            return make_message("Recurso no encontrado"), 404, headers
+        except:
+            return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+    elif request.method in ("PUT","PATCH"):
+        try:
+            dict_data = await request.get_json()
+            if validate_json(dict_data, "restaurant.json"):
+                if dict_data.get("manager_id"):
+                    manager = await db.clients.find_one({"_id":ObjectId(dict_data["manager_id"])})
+                    if not manager:
+                        return make_message("The manager doesn't exist"), 400, headers
+                else:
+                    dict_data["manager_id"]=""
+                dict_data["wines"]=[]
+                previous = await db.restaurants.find_one_and_replace({"_id": ObjectId(id)},dict_data)
+                document_cache.invalidate("restaurants", str(ObjectId(id)))
+                if previous:
+                    await record_stats("restaurants", previous, dict_data)
+                    return make_message("Actualizado exitosamente"), 200, headers
+                return make_message("El restaurante no fue hallado. Nada que actualizar"), 404, headers
+            return make_message("Parámetros inválidos o faltantes"), 400, headers
+        except DuplicateKeyError:
+            return make_message("Conflicto entre registros. Otro restaurante ya tiene ese nombre asignado"), 409, headers
+        except:
+            return make_message("No se pudo procesar la solicitud. Confirme que el id sea válido"), 400, headers
+    try:
+        previous = await db.restaurants.find_one_and_delete({"_id": ObjectId(id)})
+        document_cache.invalidate("restaurants", str(ObjectId(id)))
+        if previous:
+            await record_stats("restaurants", before=previous)
+            restaurant_id = str(ObjectId(id))
+            job_id = await cascade_worker.enqueue_async(db.jobs, sync_db.clients, "restaurants", restaurant_id)
+            return dict(make_message("Eliminado exitosamente"), job=job_id), 200, headers
+        return make_message("No se hallo el restaurante. Nada que eliminar"), 404, headers
+    except:
+        return make_message("No se pudo procesar la solicitud"), 400, headers
+
+
+@app.route("/restaurants/<string:id>/wines", methods=["GET","POST"])
+async def wines_restaurants(id):
+    if request.method == "GET":
+        try:
+            projection = get_reference_fields("restaurants", "wines")
+        except InvalidRequest as err:
+            return make_message(str(err)), 400, headers
+        try:
+            body = await get_references_body(db.restaurants, id, "wines", projection)
+            if body:
+                return body, 200, headers
+            return make_message("Restaurante no encontrado"), 404, headers
+        except:
+            return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+    try:
+        dict_data = await request.get_json()
+        if not validate_json(dict_data, "add_wine.json"):
+            return make_message("Parametros invalidos o faltantes"), 400, headers
+        wine_ids = get_reference_ids(dict_data, "wine_id", "wine_ids")
+        missing_wines = await find_missing(db.wines, wine_ids)
+        if missing_wines:
+            return dict(make_message("Could not add. Wine was not found"), missing=missing_wines), 404, headers
+        added = await add_references(db.restaurants, id, "wines", wine_ids)
+        if added is None:
+            return make_message("Restaurante no encontrado"), 404, headers
+        if added:
+            return make_message("Actualizado exitosamente"), 200, headers
+        return make_message("Vino ya existente en restaurante"), 409, headers
+    except:
+        return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+
+
+@app.route("/restaurants/<string:restaurant_id>/wines/<string:wine_id>", methods=["DELETE"])
+async def delete_wine_from_restaurant(restaurant_id:str, wine_id:str):
+    try:
+        wine_id = str(ObjectId(wine_id))
+        removed = await remove_reference(db.restaurants, restaurant_id, "wines", wine_id)
+        if removed is None:
+            return make_message("Recurso no encontrado"), 404, headers
+        if removed:
+            return make_message("Exitosamente actualizado"), 200, headers
+        return make_message("Vino no fue hallado en el restaurante. Nada que hacer"), 404, headers
+    except:
+        return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+
+
+@app.route("/clients", methods=["GET", "POST"])
+async def read_create_clients():
+    if request.method == "GET":
+        return await list_documents(db.clients)
+    dict_data = await request.get_json()
+    if validate_json(dict_data, "client.json"):
+        dict_data["restaurants"]=[]
+        try:
+            await db.clients.insert_one(dict_data)
+        except DuplicateKeyError:
+            logging.warning("Attempted to write duplicated registry in client collection")
+            return make_message("Registro duplicado"), 409, headers
+        await record_stats("clients", after=dict_data)
+        return make_message("Agregado exitosamente"), 200, headers
+    return make_message("Parámetros inválidos o faltantes"), 400, headers
+
+
+@app.route("/clients/_mget", methods=["POST"])
+async def mget_clients():
+    return await multi_get(db.clients)
+
+
+@app.route("/clients/<string:id>", methods=["GET","PUT","PATCH","DELETE"])
+async def update_delete_clients(id: str):
+    if request.method == "GET":
+        try:
+            projection = get_fields("clients")
+        except InvalidRequest as err:
+            return make_message(str(err)), 400, headers
+        try:
+            entry = await get_document_body(db.clients, id, projection)
+            if entry:
+                response = Response(entry[0], 200, headers)
+                response.set_etag(entry[1])
+                return response
+            return make_message("Recurso no encontrado"), 404, headers
+        except:
+            return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+    elif request.method in ("PUT","PATCH"):
+        try:
+            dict_data = await request.get_json()
+            if validate_json(dict_data, "client.json"):
+                dict_data["restaurants"]=[]
+                previous = await db.clients.find_one_and_replace({"_id": ObjectId(id)},dict_data)
+                document_cache.invalidate("clients", str(ObjectId(id)))
+                if previous:
+                    await record_stats("clients", previous, dict_data)
+                    return make_message("Actualizado exitosamente"), 200, headers
+                return make_message("El restaurante no fue hallado. Nada que actualizar"), 404, headers
+            return make_message("Parámetros inválidos o faltantes"), 400, headers
+        except DuplicateKeyError:
+            return make_message("Conflicto entre registros. Otro cliente ya tiene ese nombre asignado"), 409, headers
+        except:
+            return make_message("No se pudo procesar la solicitud. Confirme que el id sea válido"), 400, headers
+    try:
+        previous = await db.clients.find_one_and_delete({"_id": ObjectId(id)})
+        document_cache.invalidate("clients", str(ObjectId(id)))
+        if previous:
+            await record_stats("clients", before=previous)
+            client_id = str(ObjectId(id))
+            job_id = await cascade_worker.enqueue_async(db.jobs, sync_db.restaurants, "manager_id", client_id, CLEAR)
+            return dict(make_message("Eliminado exitosamente"), job=job_id), 200, headers
+        return make_message("No se hallo el cliente. Nada que eliminar"), 404, headers
+    except:
+        return make_message("No se pudo procesar la solicitud"), 400, headers
+
+
+@app.route("/clients/<string:id>/restaurants", methods=["GET","POST"])
+async def clients_restaurants(id):
+    if request.method == "GET":
+        try:
+            projection = get_reference_fields("clients", "restaurants")
+        except InvalidRequest as err:
+            return make_message(str(err)), 400, headers
+        try:
+            body = await get_references_body(db.clients, id, "restaurants", projection)
+            if body:
+                return body, 200, headers
+            return make_message("Restaurante no encontrado"), 404, headers
+        except:
+            return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+    try:
+        dict_data = await request.get_json()
+        if not validate_json(dict_data, "add_restaurant.json"):
+            return make_message("Parametros invalidos o faltantes"), 400, headers
+        restaurant_ids = get_reference_ids(dict_data, "restaurant_id", "restaurant_ids")
+        missing_restaurants = await find_missing(db.restaurants, restaurant_ids)
+        if missing_restaurants:
+            return dict(make_message("Could not add. Restaurant was not found"), missing=missing_restaurants), 404, headers
+        added = await add_references(db.clients, id, "restaurants", restaurant_ids)
+        if added is None:
+            return make_message("Cliente no encontrado"), 404, headers
+        if added:
+            return make_message("Actualizado exitosamente"), 200, headers
+        return make_message("Restaurante ya existente para el cliente"), 409, headers
+    except:
+        return make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers
+
+
+@app.route("/clients/<string:client_id>/restaurants/<string:restaurant_id>", methods=["DELETE"])
+async def delete_restaurant_from_client(client_id:str, restaurant_id:str):
+    try:
+        restaurant_id = str(ObjectId(restaurant_id))
+        removed = await remove_reference(db.clients, client_id, "restaurants", restaurant_id)
+        if removed is None:
+            return make_message("Recurso no encontrado"), 404, headers
+        if removed:
+            return make_message("Exitosamente actualizado"), 200, headers
+        return make_message("Restaurante no fue hallado en el cliente. Nada que hacer"), 404, headers
+    except:
+        return make_message("No se pudo procesar la solcitud. Confirme que los id's sean válido"), 400, headers
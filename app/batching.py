@@ -0,0 +1,113 @@
+import logging
+import threading
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError, WriteError
+
+
+class BatchTimeoutError(PyMongoError):
+    """The leader of a batch did not report back in time. The document may or may not
+    have been inserted"""
+
+
+class _Entry(object):
+
+    def __init__(self, document: dict):
+        self.document = document
+        self.done = threading.Event()
+        self.error = None
+
+
+class _Batch(object):
+
+    def __init__(self):
+        self.entries = []
+        self.full = threading.Event()
+
+
+class WriteBatcher(object):
+    """Groups the single-document inserts of concurrent requests of a worker.
+
+    The first request that inserts into a collection opens a batch and waits until
+    max_wait seconds pass or max_size documents join it. Then it writes the whole batch
+    with one unordered insert_many and hands every request the result of its own
+    document. Each request still waits for MongoDB to acknowledge its document before
+    it answers, so nothing is acknowledged to a client that was not written.
+    """
+
+    def __init__(self, max_wait: float = 0.005, max_size: int = 500, on_created=None, timeout: float = 10):
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.timeout = timeout
+        self.on_created = on_created
+        self._open = {}
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.documents = 0
+
+    def init_app(self, app):
+        self.max_wait = app.config['WRITE_BATCH_MAX_WAIT_MS'] / 1000
+        self.max_size = app.config['WRITE_BATCH_MAX_SIZE']
+        self.timeout = app.config['WRITE_BATCH_TIMEOUT']
+
+    def insert(self, collection, document: dict):
+        """Inserts the document as part of a batch. Behaves like insert_one: the
+        document gets its _id, and a duplicated one raises DuplicateKeyError
+
+        :param collection: The collection where the document is inserted
+        :param document: The already validated document
+        :raises BatchTimeoutError: If the batch did not finish within timeout seconds
+        """
+        entry = _Entry(document)
+        with self._lock:
+            batch = self._open.get(collection.name)
+            leader = batch is None
+            if leader:
+                batch = self._open[collection.name] = _Batch()
+            batch.entries.append(entry)
+            if len(batch.entries) >= self.max_size:
+                del self._open[collection.name]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self._lock:
+                if self._open.get(collection.name) is batch:
+                    del self._open[collection.name]
+            self._flush(collection, batch.entries)
+        elif not entry.done.wait(self.timeout):
+            raise BatchTimeoutError("The write batch of {} did not finish in {} seconds".format(
+                collection.name, self.timeout))
+        if entry.error is not None:
+            raise entry.error
+
+    def _flush(self, collection, entries: list):
+        write_errors = {}
+        failure = None
+        try:
+            collection.insert_many([entry.document for entry in entries], ordered=False)
+        except BulkWriteError as err:
+            write_errors = {error["index"]: error for error in err.details["writeErrors"]}
+        except Exception as err:
+            failure = err
+        for index, entry in enumerate(entries):
+            error = write_errors.get(index)
+            if failure is not None:
+                entry.error = failure
+            elif error is not None and error["code"] == 11000:
+                entry.error = DuplicateKeyError(error["errmsg"], error["code"], error)
+            elif error is not None:
+                entry.error = WriteError(error["errmsg"], error["code"], error)
+        with self._lock:
+            self.batches += 1
+            self.documents += len(entries)
+        for entry in entries:
+            entry.done.set()
+        if failure is None and self.on_created:
+            # The documents are already written, so a failure here must not fail the leader's request
+            try:
+                self.on_created(collection, [entry.document for entry in entries if entry.error is None])
+            except Exception:
+                logging.exception("The on_created callback of a write batch of %s failed", collection.name)
+
+    def stats(self):
+        with self._lock:
+            return {"batches": self.batches, "documents": self.documents}
@@ -0,0 +1,43 @@
+"""Chunked inserts shared by the bulk endpoints of app/routes.py and the import command
+of app/transfer.py.
+"""
+from pymongo.errors import BulkWriteError
+
+from app import db, stats
+
+
+def insert_chunk(collection, chunk: list, check_chunk=None):
+    """Inserts a chunk of (index, document) pairs with one unordered insert_many
+
+    :param collection: The collection where the documents are inserted
+    :param chunk: The already validated documents with their index in the request
+    :param check_chunk: Optional function returning the positions of the chunk that must not be inserted
+    :return: The result of every item of the chunk
+    :rtype: list
+    """
+    results = []
+    rejected = check_chunk([document for _, document in chunk]) if check_chunk else set()
+    pending = []
+    for position, (index, document) in enumerate(chunk):
+        if position in rejected:
+            results.append({"index": index, "status": "invalid"})
+        else:
+            pending.append((index, document))
+    if not pending:
+        return results
+    write_errors = {}
+    try:
+        collection.insert_many([document for _, document in pending], ordered=False)
+    except BulkWriteError as err:
+        write_errors = {error["index"]: error["code"] for error in err.details["writeErrors"]}
+    stats.record_created(db, collection.name, [document for position, (_, document) in enumerate(pending)
+                                               if position not in write_errors])
+    for position, (index, document) in enumerate(pending):
+        code = write_errors.get(position)
+        if code is None:
+            results.append({"index": index, "status": "created", "_id": str(document["_id"])})
+        elif code == 11000:
+            results.append({"index": index, "status": "duplicate"})
+        else:
+            results.append({"index": index, "status": "error"})
+    return results
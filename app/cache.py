@@ -0,0 +1,102 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class DocumentCache(object):
+    """Bounded LRU cache with a time to live, keyed by collection and document id.
+
+    It holds the already serialized response bodies of single-document reads. Each
+    worker process has its own cache, so writes done through other workers are seen
+    once the entry expires.
+
+    Every invalidation gives the document a new generation. A read takes the generation
+    before its query and only stores its body if the generation is still the same, so a
+    read that raced with a write never puts the old body back. Only the generations of
+    the last max_entries invalidated documents are kept; the others share the floor,
+    which moves up as they are dropped, so a forgotten generation can only make a set
+    be skipped, never accepted wrongly.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = OrderedDict()
+        self._clock = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def init_app(self, app):
+        """Takes the size and time to live from the CACHE_* settings"""
+        self.max_entries = app.config['CACHE_MAX_ENTRIES']
+        self.ttl = app.config['CACHE_TTL']
+
+    def get(self, collection: str, id: str):
+        """Returns the cached body of the document or None if it is missing or expired"""
+        key = (collection, id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self, collection: str, id: str):
+        """Returns the current generation of the document, to be given to set"""
+        with self._lock:
+            return self._generations.get((collection, id), self._floor)
+
+    def set(self, collection: str, id: str, value, generation: int = None):
+        """Stores the body of the document, unless it was invalidated after the given
+        generation was taken"""
+        if self.max_entries <= 0:
+            return
+        key = (collection, id)
+        with self._lock:
+            if generation is not None and self._generations.get(key, self._floor) != generation:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, collection: str, id: str):
+        key = (collection, id)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._clock += 1
+            self._generations[key] = self._clock
+            self._generations.move_to_end(key)
+            while len(self._generations) > max(self.max_entries, 1):
+                _, dropped = self._generations.popitem(last=False)
+                self._floor = max(self._floor, dropped)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
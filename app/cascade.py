@@ -0,0 +1,234 @@
+import os
+import time
+import uuid
+import socket
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import ReturnDocument
+from pymongo.errors import AutoReconnect, ConnectionFailure, ExecutionTimeout, NetworkTimeout, PyMongoError
+
+RETRYABLE_ERRORS = (AutoReconnect, ConnectionFailure, ExecutionTimeout, NetworkTimeout)
+# What a job does to the documents holding the reference
+PULL = "pull"
+CLEAR = "clear"
+UNFINISHED = ("queued", "running")
+# Fields of a job document returned by GET /jobs/<id>
+PUBLIC_FIELDS = ("collection", "status", "modified", "retries", "error", "created_at", "finished_at")
+
+
+def job_query(job: dict):
+    """Matches the documents that still hold the reference of the job"""
+    return {job["field"]: job["value"]}
+
+
+def job_update(job: dict):
+    """The update that removes the reference of the job"""
+    if job["action"] == PULL:
+        return {"$pull": {job["field"]: job["value"]}}
+    return {"$set": {job["field"]: ""}}
+
+
+def job_projection(job: dict):
+    """The part of the pre-image of every updated document passed to on_batch: its _id
+    and, when the reference is $pulled from a list, the size the list had"""
+    if job["action"] == PULL:
+        return {"size": {"$size": {"$ifNull": ["$" + job["field"], []]}}}
+    return {"_id": 1}
+
+
+def job_status(job: dict):
+    """Returns the public status of a job document"""
+    return dict({field: job.get(field) for field in PUBLIC_FIELDS}, id=job["_id"])
+
+
+class CascadeWorker(object):
+    """Runs the cleanup of the references to deleted documents in a thread pool, so the
+    DELETE requests return right away.
+
+    Every job repeatedly takes a batch of the ids that match a query and applies an
+    update to them, until no document matches. A $pull updates each document with its
+    own find_one_and_update, so the size its list had before this very write is known;
+    clearing a field uses one update_many per batch. Batches that fail with a network
+    error are retried with exponential backoff.
+
+    Jobs are kept in the jobs collection, so their status can be read from any worker,
+    and a job left unfinished by a worker that died is taken over by the next one that
+    starts. A worker renews the lease of its job on every batch; a job whose lease is
+    older than lease seconds is considered abandoned. Finished jobs expire after ttl
+    seconds through a TTL index. on_batch, if given, is called with the collection, the
+    field, the action and the pre-images of the documents of every batch, see
+    job_projection.
+    """
+
+    def __init__(self, max_workers: int = 2, batch_size: int = 500, max_retries: int = 5, lease: float = 30,
+                 ttl: float = 86400, on_batch=None):
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.lease = lease
+        self.ttl = ttl
+        self.on_batch = on_batch
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="cascade")
+
+    def init_app(self, app):
+        """Takes the pool size, batch size, retries, lease and TTL from the CASCADE_*
+        settings. The pool only starts its threads on the first job, so it is safe to
+        build before a fork"""
+        self.batch_size = app.config['CASCADE_BATCH_SIZE']
+        self.max_retries = app.config['CASCADE_MAX_RETRIES']
+        self.lease = app.config['CASCADE_JOB_LEASE']
+        self.ttl = app.config['CASCADE_JOB_TTL']
+        self._executor = ThreadPoolExecutor(app.config['CASCADE_WORKERS'], thread_name_prefix="cascade")
+
+    @staticmethod
+    def owner():
+        return "{}:{}".format(socket.gethostname(), os.getpid())
+
+    def enqueue(self, collection, field: str, value: str, action: str = PULL):
+        """Schedules a cleanup job. If the job can not be stored it still runs, but its
+        status can not be read
+
+        :param collection: The collection holding the references
+        :param field: The field holding the reference, e.g. wines
+        :param value: The reference, i.e. the id of the deleted document
+        :param action: PULL to $pull it from a list, CLEAR to set the field to ""
+        :return: The id of the job
+        :rtype: str
+        """
+        job = self.new_job(collection, field, value, action)
+        try:
+            collection.database.jobs.insert_one(job)
+        except PyMongoError as err:
+            logging.error("Could not store the cascade job %s: %s", job["_id"], err)
+        return self.start(job, collection)
+
+    async def enqueue_async(self, jobs, collection, field: str, value: str, action: str = PULL):
+        """Same as enqueue for the async app: the job is stored with jobs, the Motor
+        collection of the jobs, so the event loop never waits on PyMongo. The job itself
+        runs on the pool with the PyMongo collection, like any other"""
+        job = self.new_job(collection, field, value, action)
+        try:
+            await jobs.insert_one(job)
+        except PyMongoError as err:
+            logging.error("Could not store the cascade job %s: %s", job["_id"], err)
+        return self.start(job, collection)
+
+    def new_job(self, collection, field: str, value: str, action: str):
+        return {
+            "_id": uuid.uuid4().hex,
+            "collection": collection.name,
+            "field": field,
+            "value": value,
+            "action": action,
+            "status": "queued",
+            "modified": 0,
+            "retries": 0,
+            "error": None,
+            "created_at": time.time(),
+            "finished_at": None,
+            "owner": self.owner(),
+            "heartbeat": time.time(),
+        }
+
+    def start(self, job, collection):
+        self._executor.submit(self._run, job, collection)
+        return job["_id"]
+
+    def status(self, db, job_id: str):
+        """Returns the status of the job or None if it is unknown"""
+        job = db.jobs.find_one({"_id": job_id})
+        return job_status(job) if job else None
+
+    def resume(self, db):
+        """Takes over the unfinished jobs whose lease expired. Runs when a worker starts
+
+        :return: The number of jobs resumed
+        :rtype: int
+        """
+        resumed = 0
+        try:
+            while True:
+                now = time.time()
+                job = db.jobs.find_one_and_update(
+                    {"status": {"$in": list(UNFINISHED)}, "heartbeat": {"$lt": now - self.lease}},
+                    {"$set": {"owner": self.owner(), "heartbeat": now}})
+                if not job:
+                    break
+                logging.info("Resuming the cascade job %s on %s", job["_id"], job["collection"])
+                self._executor.submit(self._run, job, db[job["collection"]])
+                resumed += 1
+        except PyMongoError as err:
+            logging.error("Could not resume the cascade jobs: %s", err)
+        return resumed
+
+    def _save(self, job, collection, finished: bool = False):
+        """Writes the progress of the job and renews its lease"""
+        changes = {field: job[field] for field in ("status", "modified", "retries", "error", "finished_at")}
+        changes["heartbeat"] = time.time()
+        if finished:
+            changes["expires_at"] = datetime.utcnow() + timedelta(seconds=self.ttl)
+        try:
+            collection.database.jobs.update_one({"_id": job["_id"], "owner": job["owner"]}, {"$set": changes})
+        except PyMongoError as err:
+            logging.error("Could not save the cascade job %s: %s", job["_id"], err)
+
+    def _run(self, job, collection):
+        job["owner"] = self.owner()
+        job["status"] = "running"
+        self._save(job, collection)
+        query = job_query(job)
+        update = job_update(job)
+        try:
+            while True:
+                ids = self._retry(job, lambda: [document["_id"] for document in
+                                               collection.find(query, {"_id": 1}).limit(self.batch_size)])
+                if not ids:
+                    break
+                if job["action"] == PULL:
+                    previous = self._pull_batch(job, collection, ids)
+                    job["modified"] += len(previous)
+                else:
+                    batch_query = dict(query, _id={"$in": ids})
+                    result = self._retry(job, lambda: collection.update_many(batch_query, update))
+                    job["modified"] += result.modified_count
+                    previous = [{"_id": object_id} for object_id in ids]
+                if self.on_batch:
+                    self.on_batch(collection, job["field"], job["action"], previous)
+                self._save(job, collection)
+            job["status"] = "done"
+        except Exception as err:
+            logging.exception("Cascade job %s on %s failed", job["_id"], collection.name)
+            job["status"] = "failed"
+            job["error"] = str(err)
+        job["finished_at"] = time.time()
+        self._save(job, collection, finished=True)
+
+    def _pull_batch(self, job, collection, ids: list):
+        """Pulls the reference from every document of the batch that still holds it
+
+        :return: The pre-images of the documents that were modified
+        :rtype: list
+        """
+        update = job_update(job)
+        projection = job_projection(job)
+        previous = []
+        for object_id in ids:
+            # A retry after a write that did go through matches nothing, so no document is counted twice
+            document = self._retry(job, lambda: collection.find_one_and_update(
+                dict(job_query(job), _id=object_id), update, projection, return_document=ReturnDocument.BEFORE))
+            if document:
+                previous.append(document)
+        return previous
+
+    def _retry(self, job, operation):
+        delay = 0.1
+        for attempt in range(self.max_retries + 1):
+            try:
+                return operation()
+            except RETRYABLE_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                job["retries"] += 1
+                time.sleep(delay)
+                delay *= 2
@@ -0,0 +1,103 @@
+"""gzip and brotli compression of the responses, negotiated with Accept-Encoding.
+
+Bodies smaller than COMPRESS_MIN_SIZE are sent as they are, since compressing them
+costs more CPU than the bytes it saves. Streamed responses (the NDJSON exports) are
+compressed chunk by chunk. brotli is only offered when the brotli package is installed.
+"""
+import gzip
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson", "text/plain")
+
+
+def supported_encodings():
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def choose_encoding(accept_encodings):
+    """Returns the encoding preferred by the client among the supported ones, or None
+
+    :param accept_encodings: The parsed Accept-Encoding header of the request
+    :rtype: str
+    """
+    return accept_encodings.best_match(supported_encodings())
+
+
+def compress(data: bytes, encoding: str, level: int):
+    if encoding == "br":
+        # The brotli quality goes from 0 to 11, the level from 1 to 9
+        return brotli.compress(data, quality=min(11, level))
+    return gzip.compress(data, compresslevel=level)
+
+
+def compress_chunks(chunks, encoding: str, level: int, flush_size: int = 65536):
+    """Compresses an iterable of chunks as one stream. The compressor is flushed, so the
+    client gets what was compressed so far, once every flush_size bytes of input rather
+    than after every chunk, which would compress each NDJSON line as its own block"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=min(11, level))
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        # wbits of 16 + MAX_WBITS writes the gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+
+        def flush():
+            return compressor.flush(zlib.Z_SYNC_FLUSH)
+    pending = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = process(chunk)
+        pending += len(chunk)
+        if pending >= flush_size:
+            data += flush()
+            pending = 0
+        if data:
+            yield data
+    yield finish()
+
+
+def is_compressible(response):
+    return (response.mimetype in COMPRESSIBLE_MIMETYPES
+            and "Content-Encoding" not in response.headers
+            and 200 <= response.status_code < 300 and response.status_code != 204)
+
+
+def mark_encoded(response, encoding: str):
+    """Sets the headers of a compressed response. A strong ETag identifies the exact
+    bytes, so it is weakened to keep matching the If-None-Match of the other encodings"""
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response):
+    """after_request hook of the Flask app"""
+    if not is_compressible(response):
+        return response
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        response.vary.add("Accept-Encoding")
+        return response
+    level = current_app.config["COMPRESS_LEVEL"]
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding, level,
+                                            current_app.config["COMPRESS_FLUSH_SIZE"])
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return response
+        response.set_data(compress(data, encoding, level))
+    mark_encoded(response, encoding)
+    return response
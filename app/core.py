@@ -0,0 +1,405 @@
+"""Request-independent part of the CRUD API.
+
+Shared by the Flask routes (app/routes.py) and the async ones (app/aio.py): the
+validation of the parameters, the queries and pipelines built from them and the shape
+of the results. Nothing here reads the request or talks to MongoDB; each front end does
+its own I/O around these functions, so both answer exactly the same.
+"""
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from werkzeug.http import generate_etag
+
+from app import encoder
+
+headers = {"Content-Type": "application/json"}
+
+# Relationship fields that can be resolved with ?expand=, and the collection they point to
+EXPANDABLE_FIELDS = {
+    "restaurants": {"wines": "wines"},
+    "clients": {"restaurants": "restaurants"},
+}
+
+# Fields that can be filtered by exact value (?country=Chile) and by range
+# (?year_min=2000&year_max=2010). ?q= searches the text index of the collection
+FILTER_FIELDS = {
+    "wines": ("country", "type"),
+    "restaurants": ("name", "address"),
+    "clients": ("name", "email"),
+}
+RANGE_FIELDS = {
+    "wines": ("year",),
+}
+
+
+class InvalidRequest(ValueError):
+    """A parameter of the request is not valid. The message is the one answered to the
+    client with a 400"""
+
+
+def make_message(message:str):
+    return {"msg":message}
+
+
+def document_entry(document: dict):
+    """Returns the serialized response body of one document and its ETag"""
+    body = encoder.dumps({"body":document})
+    return body, generate_etag(body)
+
+
+def parse_expand(value: str, collection_name: str):
+    """Parses the ?expand= parameter
+
+    :raises ValueError: If the field can not be expanded on the given collection
+    :return: The field to be expanded or None
+    :rtype: str
+    """
+    if not value:
+        return None
+    if value not in EXPANDABLE_FIELDS.get(collection_name, {}):
+        raise ValueError("{} can not be expanded".format(value))
+    return value
+
+
+def parse_fields(value: str, schema: dict, extra_fields=()):
+    """Turns a ?fields= parameter into a MongoDB projection, so the other fields are
+    never read nor serialized. Only the properties of the schema, the extra fields
+    (the lists of references) and _id can be asked for; _id is always returned
+
+    :param value: The comma separated fields, e.g. name,year,country, or None
+    :param schema: The JSON schema of the documents
+    :param extra_fields: Stored fields that are not part of the schema
+    :raises ValueError: If the list is empty or holds an unknown field
+    :return: The projection, or None to read whole documents
+    :rtype: dict
+    """
+    if value is None:
+        return None
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    allowed = set(schema.get("properties", {})) | set(extra_fields) | {"_id"}
+    if not fields or any(field not in allowed for field in fields):
+        raise ValueError("Unknown fields {}".format(value))
+    return {field: 1 for field in fields}
+
+
+def collection_fields(value: str, collection_name: str, schema: dict):
+    """Parses the ?fields= parameter for the documents of the given collection
+
+    :param schema: The JSON schema of the collection
+    :raises InvalidRequest: If a field is unknown
+    :rtype: dict
+    """
+    try:
+        return parse_fields(value, schema, EXPANDABLE_FIELDS.get(collection_name, {}))
+    except ValueError:
+        raise InvalidRequest("Parámetro fields inválido")
+
+
+def reference_fields(args, collection_name: str, field: str, schema: dict):
+    """Parses the ?fields= parameter of a read of the references of a document, which
+    only applies to the documents joined with ?expand=
+
+    :param args: The query string arguments of the request
+    :param schema: The JSON schema of the referenced collection
+    :raises InvalidRequest: If a field is unknown or the references are not expanded
+    :rtype: dict
+    """
+    projection = collection_fields(args.get("fields"), EXPANDABLE_FIELDS[collection_name][field], schema)
+    if projection and args.get("expand") != field:
+        raise InvalidRequest("El parámetro fields requiere expand={}".format(field))
+    return projection
+
+
+def get_filters(collection_name: str, args):
+    """Builds the query of the filters given in the query string. Every filter is pushed
+    down to MongoDB and backed by one of the indexes of app/indexes.py
+
+    :param collection_name: The name of the listed collection
+    :param args: The query string arguments of the request
+    :raises ValueError: If a range bound is not a number or q is empty
+    :return: The query
+    :rtype: dict
+    """
+    query = {}
+    for field in FILTER_FIELDS.get(collection_name, ()):
+        value = args.get(field)
+        if value is not None:
+            query[field] = value
+    for field in RANGE_FIELDS.get(collection_name, ()):
+        bounds = {}
+        for suffix, operator in (("_min", "$gte"), ("_max", "$lte")):
+            value = args.get(field + suffix)
+            if value is not None:
+                bounds[operator] = float(value)
+        if bounds:
+            query[field] = bounds
+    text = args.get("q")
+    if text is not None:
+        if not text.strip():
+            raise ValueError("q can not be empty")
+        query["$text"] = {"$search": text}
+    return query
+
+
+def parse_limit(value: str, default: int, maximum: int):
+    """Parses the ?limit= parameter
+
+    :raises ValueError: If it is given and is not a positive integer
+    :return: The page size, capped to maximum
+    :rtype: int
+    """
+    if value is None:
+        return default
+    limit = int(value)
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return min(limit, maximum)
+
+
+def parse_after(after: str, ranked: bool):
+    """Parses the ?after= cursor. Plain listings are sorted by _id, so the cursor is an
+    id. Text searches are sorted by relevance, so their cursor is score:id"""
+    if not after:
+        return None
+    if ranked:
+        score, _, after_id = after.partition(":")
+        return float(score), ObjectId(after_id)
+    return ObjectId(after)
+
+
+def make_next_cursor(document: dict, ranked: bool):
+    if ranked:
+        return "{!r}:{}".format(document["_score"], document["_id"])
+    return str(document["_id"])
+
+
+def lookup_stages(collection_name: str, field: str, projection: dict = None):
+    """Returns the aggregation stages that join the documents referenced by the string
+    ids of the given field. The ids are first converted to ObjectId's, invalid ones to
+    null, so the $lookup is a plain equality join on the _id index of the other
+    collection. The projection, if any, applies to the joined documents"""
+    stages = [
+        {"$addFields": {"_expanded_ids": {"$map": {
+            "input": {"$ifNull": ["$" + field, []]},
+            "as": "id",
+            "in": {"$convert": {"input": "$$id", "to": "objectId", "onError": None, "onNull": None}},
+        }}}},
+        {"$lookup": {
+            "from": EXPANDABLE_FIELDS[collection_name][field],
+            "localField": "_expanded_ids",
+            "foreignField": "_id",
+            "as": "_expanded",
+        }},
+    ]
+    if projection:
+        kept = dict({name: "$$related." + name for name in projection}, _id="$$related._id")
+        stages.append({"$addFields": {"_expanded": {"$map": {"input": "$_expanded", "as": "related", "in": kept}}}})
+    stages.append({"$project": {"_expanded_ids": 0}})
+    return stages
+
+
+def merge_expanded(document: dict, field: str):
+    """Replaces the ids of the field with the documents joined by lookup_stages, keeping
+    the stored order. Ids of documents that no longer exist are dropped"""
+    expanded = {str(related["_id"]): related for related in document.pop("_expanded", [])}
+    document[field] = [expanded[related_id] for related_id in document.get(field, []) if related_id in expanded]
+    return document
+
+
+def expanded_pipeline(collection_name: str, id: str, field: str, projection: dict = None):
+    """Returns the aggregation that reads one document with the given field expanded
+
+    :raises bson.errors.InvalidId: If the id is not a valid ObjectId
+    :rtype: list
+    """
+    return [{"$match": {"_id": ObjectId(id)}}] + lookup_stages(collection_name, field, projection)
+
+
+def references_body(document: dict, field: str):
+    """Returns the serialized response body of the references held by a document"""
+    return encoder.dumps({"body":document[field]})
+
+
+def list_pipeline(collection_name: str, query: dict, after, limit, expand, projection: dict = None):
+    """Returns the aggregation of a listing that needs one: a text search, ranked by
+    its textScore (kept in _score) and then by _id, or an expanded listing
+
+    :param collection_name: The name of the listed collection
+    :param query: The filters, already holding the _id bound of plain listings
+    :param after: The (score, id) cursor of a text search or None
+    :param limit: The number of documents to read or None
+    :param expand: The field to be expanded or None
+    :param projection: The fields to be read or None, already holding the expanded one
+    :rtype: list
+    """
+    pipeline = [{"$match": query}]
+    if "$text" in query:
+        pipeline.append({"$addFields": {"_score": {"$meta": "textScore"}}})
+        if after:
+            score, after_id = after
+            pipeline.append({"$match": {"$or": [{"_score": {"$lt": score}},
+                                                {"_score": score, "_id": {"$gt": after_id}}]}})
+        pipeline.append({"$sort": {"_score": -1, "_id": ASCENDING}})
+    else:
+        pipeline.append({"$sort": {"_id": ASCENDING}})
+    if limit:
+        pipeline.append({"$limit": limit})
+    if projection:
+        pipeline.append({"$project": dict(projection, _score=1) if "$text" in query else projection})
+    if expand:
+        pipeline += lookup_stages(collection_name, expand)
+    return pipeline
+
+
+def plan_listing(collection_name: str, args, schema: dict, streaming: bool, default_limit: int, max_limit: int):
+    """Validates the parameters of a listing and builds its query. A page reads one
+    extra document to know if there is a next page without a second query; an NDJSON
+    export reads the whole collection, or up to ?limit=
+
+    :param collection_name: The name of the listed collection
+    :param args: The query string arguments of the request
+    :param schema: The JSON schema of the collection, for ?fields=
+    :param streaming: Whether the listing is exported as NDJSON
+    :param default_limit: The page size when ?limit= is not given
+    :param max_limit: The largest page size
+    :raises InvalidRequest: If a parameter is not valid
+    :return: The query, projection, expand, ranked, limit (the documents to read, or
+        None) and page_size of the listing, and its pipeline, or None if a find with a
+        sort on _id is enough
+    :rtype: dict
+    """
+    try:
+        page_size = parse_limit(args.get("limit"), default_limit, max_limit)
+        after = parse_after(args.get("after"), "q" in args)
+    except Exception:
+        raise InvalidRequest("Parámetros de paginación inválidos")
+    try:
+        expand = parse_expand(args.get("expand"), collection_name)
+    except ValueError:
+        raise InvalidRequest("Parámetro expand inválido")
+    projection = collection_fields(args.get("fields"), collection_name, schema)
+    if projection and expand:
+        projection[expand] = 1
+    try:
+        query = get_filters(collection_name, args)
+    except ValueError:
+        raise InvalidRequest("Filtros inválidos")
+    ranked = "$text" in query
+    if after and not ranked:
+        query["_id"] = {"$gt": after}
+    if streaming:
+        limit = page_size if "limit" in args else None
+    else:
+        limit = page_size + 1
+    pipeline = None
+    if expand or ranked:
+        pipeline = list_pipeline(collection_name, query, after, limit, expand, projection)
+    return {"query": query, "projection": projection, "expand": expand, "ranked": ranked, "limit": limit,
+            "page_size": page_size, "pipeline": pipeline}
+
+
+def listed_document(document: dict, plan: dict):
+    """Shapes a document read by a listing: joins its expanded field and drops the
+    internal text score"""
+    if plan["expand"]:
+        merge_expanded(document, plan["expand"])
+    document.pop("_score", None)
+    return document
+
+
+def ndjson_line(document: dict, plan: dict):
+    return encoder.dumps(listed_document(document, plan)) + b"\n"
+
+
+def page_body(documents: list, plan: dict):
+    """Returns the serialized response body of a page and the cursor of the next one,
+    if the extra document was read"""
+    next_cursor = None
+    if len(documents) > plan["page_size"]:
+        documents = documents[:plan["page_size"]]
+        next_cursor = make_next_cursor(documents[-1], plan["ranked"])
+    documents = [listed_document(document, plan) for document in documents]
+    return encoder.dumps({"body":documents, "next":next_cursor})
+
+
+def split_ids(value: str):
+    """Returns the ids of a ?ids=a,b,c parameter"""
+    return [id.strip() for id in (value or "").split(",") if id.strip()]
+
+
+def parse_ids(ids, max_ids: int):
+    """Checks the ids of a multi-get and converts the valid ones
+
+    :param ids: The requested ids, in the order they were requested
+    :param max_ids: The most ids a request may ask for
+    :raises InvalidRequest: If ids is not a list of up to max_ids strings
+    :return: Every id with its ObjectId, or None if it is not a valid one
+    :rtype: list
+    """
+    if not isinstance(ids, list) or not all(isinstance(id, str) for id in ids) or not ids or len(ids) > max_ids:
+        raise InvalidRequest("Se esperaba una lista de entre 1 y {} ids".format(max_ids))
+    return [(id, ObjectId(id) if ObjectId.is_valid(id) else None) for id in ids]
+
+
+def mget_query(requested: list):
+    """Returns the query of a multi-get, or None if no requested id is valid"""
+    object_ids = list({object_id for _, object_id in requested if object_id is not None})
+    return {"_id": {"$in": object_ids}} if object_ids else None
+
+
+def mget_results(requested: list, documents):
+    """Returns one result per requested id, in the order requested: found with its
+    document, not_found or invalid"""
+    found = {document["_id"]: document for document in documents}
+    results = []
+    for id, object_id in requested:
+        if object_id is None:
+            results.append({"id": id, "status": "invalid"})
+        elif object_id in found:
+            results.append({"id": id, "status": "found", "document": found[object_id]})
+        else:
+            results.append({"id": id, "status": "not_found"})
+    return results
+
+
+def get_reference_ids(dict_data: dict, single_key: str, batch_key: str):
+    """Returns the normalized ids of a relationship request, which holds either one id
+    (e.g. wine_id) or a list of them (e.g. wine_ids). Repeated ids are dropped
+
+    :raises bson.errors.InvalidId: If any of the ids is not a valid ObjectId
+    :rtype: list
+    """
+    raw_ids = dict_data[batch_key] if batch_key in dict_data else [dict_data[single_key]]
+    reference_ids = []
+    for raw_id in raw_ids:
+        reference_id = str(ObjectId(raw_id))
+        if reference_id not in reference_ids:
+            reference_ids.append(reference_id)
+    return reference_ids
+
+
+def references_query(reference_ids: list):
+    """Returns the query that reads the _id of the referenced documents that exist"""
+    return {"_id": {"$in": [ObjectId(reference_id) for reference_id in reference_ids]}}
+
+
+def missing_references(reference_ids: list, documents):
+    """Returns the ids of the list whose document was not read by references_query"""
+    existing_ids = {str(document["_id"]) for document in documents}
+    return [reference_id for reference_id in reference_ids if reference_id not in existing_ids]
+
+
+def reference_projection(field: str, reference_ids: list):
+    """Returns the projection of the pre-image of a link or unlink: the size of the list
+    and which of the given references it already held, instead of the list itself"""
+    references = {"$ifNull": ["$" + field, []]}
+    return {"size": {"$size": references}, "held": {"$setIntersection": [references, reference_ids]}}
+
+
+def prepare_restaurant(dict_data: dict):
+    dict_data["wines"]=[]
+    if not dict_data.get("manager_id"):
+        dict_data["manager_id"]=""
+
+
+def prepare_client(dict_data: dict):
+    dict_data["restaurants"]=[]
@@ -0,0 +1,43 @@
+import os
+import threading
+
+from pymongo import MongoClient
+
+
+class MongoConnection(object):
+    """Creates the MongoClient of the current process on first use.
+
+    MongoClient starts background threads and opens sockets, which are not safe to
+    share with a forked child. The client is therefore never built at import time or
+    by create_app, and a process whose pid differs from the one that built it (e.g. a
+    gunicorn worker forked from a --preload master) gets its own client.
+    """
+
+    def __init__(self, event_listeners=()):
+        self.event_listeners = list(event_listeners)
+        self.uri = None
+        self._client = None
+        self._database = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.uri = app.config['MONGO_URI']
+
+    @property
+    def client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self.uri is None:
+                        raise RuntimeError("MongoConnection.init_app was not called")
+                    self._client = MongoClient(self.uri, event_listeners=self.event_listeners)
+                    self._database = self._client.get_default_database()
+                    self._pid = os.getpid()
+        return self._client
+
+    @property
+    def db(self):
+        """Returns the database named in MONGO_URI"""
+        self.client
+        return self._database
@@ -0,0 +1,29 @@
+"""Serializes documents read from MongoDB straight into JSON bytes.
+
+ObjectId, datetime and the other BSON types are given the same extended JSON form as
+bson.json_util.dumps (e.g. {"$oid": "..."}), but in a single pass: there is no
+intermediate tree of plain Python objects. orjson is used when it is installed and the
+standard json module otherwise.
+"""
+import json
+
+from bson import json_util
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    # datetime is left to json_util, since orjson would write it as an ISO string
+    # instead of {"$date": ...}
+    OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(obj) -> bytes:
+        """Returns the JSON of the given object as UTF-8 bytes"""
+        return orjson.dumps(obj, default=json_util.default, option=OPTIONS)
+else:
+    def dumps(obj) -> bytes:
+        """Returns the JSON of the given object as UTF-8 bytes"""
+        return json.dumps(obj, default=json_util.default, ensure_ascii=False,
+                          separators=(",", ":")).encode()
@@ -0,0 +1,56 @@
+import logging
+
+from pymongo import ASCENDING, TEXT, IndexModel
+from pymongo.errors import PyMongoError
+
+# Indexes created at startup. The unique name indexes are the ones enforcing that
+# there are no duplicated wines, restaurants or clients. The filter indexes put the
+# equality fields first and _id after them, so a filtered page is read in _id order
+# straight from the index. The text indexes skip stemming since names mix languages
+INDEXES = {
+    "wines": [
+        IndexModel([("name", ASCENDING)], unique=True, name="name_unique"),
+        IndexModel([("country", ASCENDING), ("type", ASCENDING), ("_id", ASCENDING)], name="country_type"),
+        IndexModel([("type", ASCENDING), ("_id", ASCENDING)], name="type"),
+        IndexModel([("year", ASCENDING)], name="year"),
+        IndexModel([("name", TEXT)], default_language="none", name="text"),
+    ],
+    "restaurants": [
+        IndexModel([("name", ASCENDING)], unique=True, name="name_unique"),
+        IndexModel([("address", ASCENDING), ("_id", ASCENDING)], name="address"),
+        IndexModel([("name", TEXT), ("address", TEXT)], default_language="none", name="text"),
+        # Multikey indexes used by the cascade cleanup to find the references
+        IndexModel([("wines", ASCENDING)], name="wines"),
+        IndexModel([("manager_id", ASCENDING)], name="manager_id"),
+    ],
+    "clients": [
+        IndexModel([("name", ASCENDING)], unique=True, name="name_unique"),
+        IndexModel([("restaurants", ASCENDING)], name="restaurants"),
+        IndexModel([("email", ASCENDING), ("_id", ASCENDING)], name="email"),
+        IndexModel([("name", TEXT), ("email", TEXT)], default_language="none", name="text"),
+    ],
+    # Cascade cleanup jobs, see app/cascade.py. Finished jobs are removed at expires_at
+    "jobs": [
+        IndexModel([("status", ASCENDING), ("heartbeat", ASCENDING)], name="status_heartbeat"),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_at"),
+    ],
+    # One document per group of the catalog statistics, see app/stats.py
+    "stats": [
+        IndexModel([("collection", ASCENDING), ("field", ASCENDING), ("key", ASCENDING)], unique=True,
+                   name="group_unique"),
+    ],
+}
+
+
+def ensure_indexes(db):
+    """Creates the indexes of every collection. Creating an index that already exists
+    is a no-op, so this is safe to run on every startup
+
+    :param db: The database
+    """
+    for collection, indexes in INDEXES.items():
+        try:
+            db[collection].create_indexes(indexes)
+        except PyMongoError as err:
+            # E.g. the collection already holds duplicated names
+            logging.error("Could not create the indexes of the %s collection: %s", collection, err)
@@ -0,0 +1,167 @@
+"""Non-blocking structured logging.
+
+Request threads only put the records in a bounded queue through a QueueHandler; a
+QueueListener thread formats them as JSON lines and writes them to the real handler
+(the rotating file or the stream). When the queue is full the record is dropped and
+counted instead of making the request wait. Every record logged during a request
+carries its request id and route, and each request logs one "request" event with its
+status and latency. INFO events can be sampled with LOG_SAMPLE_RATE; warnings and
+errors are always kept.
+"""
+import os
+import copy
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import has_request_context, request
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# Extra attributes of the records that become fields of the JSON line
+EXTRA_FIELDS = ("request_id", "method", "route", "status", "latency_ms", "remote_addr", "commands")
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON"""
+
+    def format(self, record):
+        line = {
+            "time": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                line[field] = value
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+class RequestQueueHandler(QueueHandler):
+    """QueueHandler that never blocks. It adds the request fields in the request thread,
+    since the listener thread has no request context, and drops the INFO records that
+    are not sampled before they are queued"""
+
+    def __init__(self, pipeline):
+        super().__init__(None)
+        self.pipeline = pipeline
+
+    def emit(self, record):
+        if record.levelno < logging.WARNING and not getattr(record, "sampled", False):
+            if not self.pipeline.sampled():
+                return
+        if has_request_context() and not hasattr(record, "request_id"):
+            record.request_id = request.environ.get("log.request_id")
+            record.route = request.url_rule.rule if request.url_rule else None
+        super().emit(record)
+
+    def prepare(self, record):
+        """Like QueueHandler.prepare, but the traceback is kept in exc_text instead of
+        being appended to the message, so the JSON line has it in its own field. It is
+        formatted here because the traceback objects can not be queued"""
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.pipeline.get_queue().put_nowait(record)
+        except queue.Full:
+            self.pipeline.dropped += 1
+
+
+class LogPipeline(object):
+    """Owns the queue and the listener of the current process. Both are created on the
+    first record logged by a process, so a gunicorn worker forked from a --preload
+    master starts its own listener thread instead of inheriting a dead one"""
+
+    def __init__(self):
+        self.handlers = []
+        self.queue_size = 10000
+        self.sample_rate = 1.0
+        self.dropped = 0
+        self._queue = None
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._queue_handler = RequestQueueHandler(self)
+
+    def init_app(self, app, handlers: list):
+        """Sends the records of the root logger, and so of app.logger and of the modules
+        that use logging directly, through the queue to the given handlers"""
+        self.stop()
+        self.handlers = list(handlers)
+        self.queue_size = app.config['LOG_QUEUE_SIZE']
+        self.sample_rate = app.config['LOG_SAMPLE_RATE']
+        root = logging.getLogger()
+        if self._queue_handler not in root.handlers:
+            root.addHandler(self._queue_handler)
+        app.before_request(self.start_request)
+        app.after_request(self.log_request)
+
+    def get_queue(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(self.queue_size)
+                    self._listener = QueueListener(self._queue, *self.handlers, respect_handler_level=True)
+                    self._listener.start()
+                    self._pid = os.getpid()
+                    atexit.register(self.stop)
+        return self._queue
+
+    def stop(self):
+        """Writes the queued records and stops the listener of this process"""
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def start_request(self):
+        environ = request.environ
+        request_id = request.headers.get(REQUEST_ID_HEADER, "")
+        if not request_id or len(request_id) > 64 or not request_id.isprintable():
+            request_id = uuid.uuid4().hex
+        environ["log.request_id"] = request_id
+        environ["log.request_started"] = time.perf_counter()
+
+    def log_request(self, response):
+        """Logs the request event, if sampled, and echoes the request id"""
+        current_request = request._get_current_object()
+        environ = current_request.environ
+        request_id = environ.get("log.request_id")
+        if request_id is None:
+            return response
+        response.headers[REQUEST_ID_HEADER] = request_id
+        if self.sampled():
+            latency = time.perf_counter() - environ["log.request_started"]
+            logging.getLogger("app.requests").info("request", extra={
+                "sampled": True,
+                "request_id": request_id,
+                "method": current_request.method,
+                "route": current_request.url_rule.rule if current_request.url_rule else None,
+                "status": response.status_code,
+                "latency_ms": round(latency * 1000, 3),
+                "remote_addr": current_request.remote_addr,
+            })
+        return response
@@ -0,0 +1,278 @@
+import time
+import threading
+from bisect import bisect_left
+
+from flask import request
+from pymongo import monitoring
+
+# Upper bounds, in seconds, of the latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter(object):
+    """Monotonic counter with labels, exposed in the Prometheus text format"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield self.name + format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+
+    kind = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value=0):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(object):
+    """Histogram with fixed buckets. Observing a value is a bisect and three additions
+    under a lock, so it stays in the order of a microsecond"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][position] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {label_values: ([list(entry[0])] + entry[1:]) for label_values, entry in self._values.items()}
+        names = self.labels + ("le",)
+        for label_values, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket" + format_labels(names, label_values + (bound,)), cumulative
+            yield self.name + "_sum" + format_labels(self.labels, label_values), total
+            yield self.name + "_count" + format_labels(self.labels, label_values), count
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Adds a function called on every scrape that returns extra metrics, for values
+        that are already counted somewhere else (e.g. the document cache)"""
+        self._collectors.append(collector)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        metrics = list(self._metrics)
+        for collector in self._collectors:
+            metrics.extend(collector())
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append("{} {}".format(sample, value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "HTTP requests by endpoint, method and status code", ("endpoint", "method", "status")))
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by endpoint and method", ("endpoint", "method")))
+mongodb_command_duration = registry.register(Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command latency by collection, command and outcome",
+    ("collection", "command", "outcome")))
+mongodb_pool_checked_out = registry.register(Gauge(
+    "mongodb_pool_checked_out_connections", "Connections currently checked out of the pool", ("address",)))
+mongodb_pool_wait = registry.register(Histogram(
+    "mongodb_pool_checkout_wait_seconds", "Time spent waiting to check out a connection", ("address",)))
+mongodb_pool_checkout_failures = registry.register(Counter(
+    "mongodb_pool_checkout_failures_total", "Failed connection check outs by reason", ("address", "reason")))
+
+
+def start_request_timer():
+    request.environ["metrics.request_started"] = time.perf_counter()
+
+
+def record_request(response):
+    """Counts the request and observes its latency, labeled by the route rule so the
+    label values stay bounded. The request proxy is resolved only once, since every
+    lookup through it costs a few microseconds"""
+    current_request = request._get_current_object()
+    started = current_request.environ.get("metrics.request_started")
+    if started is None:
+        return response
+    endpoint = current_request.url_rule.rule if current_request.url_rule else "unmatched"
+    http_request_duration.observe(time.perf_counter() - started, endpoint, current_request.method)
+    http_requests.inc(endpoint, current_request.method, str(response.status_code))
+    return response
+
+
+def cache_collector(cache):
+    """Returns a collector exposing the counters of a DocumentCache"""
+    def collect():
+        stats = cache.stats()
+        metrics = []
+        for name in ("hits", "misses", "evictions", "expirations"):
+            counter = Counter("document_cache_{}_total".format(name), "Document cache {}".format(name))
+            counter.inc(amount=stats[name])
+            metrics.append(counter)
+        entries = Gauge("document_cache_entries", "Documents currently cached")
+        entries.set(value=stats["entries"])
+        metrics.append(entries)
+        return metrics
+    return collect
+
+
+def singleflight_collector(single_flight):
+    """Returns a collector exposing the counters of a SingleFlight"""
+    def collect():
+        stats = single_flight.stats()
+        executed = Counter("singleflight_executed_queries_total", "Reads that ran a MongoDB query")
+        executed.inc(amount=stats["executed"])
+        shared = Counter("singleflight_saved_queries_total", "Reads served by a concurrent identical query")
+        shared.inc(amount=stats["shared"])
+        timeouts = Counter("singleflight_wait_timeouts_total", "Reads that stopped waiting and ran their own query")
+        timeouts.inc(amount=stats["timeouts"])
+        return [executed, shared, timeouts]
+    return collect
+
+
+def write_batcher_collector(write_batcher):
+    """Returns a collector exposing the counters of a WriteBatcher"""
+    def collect():
+        stats = write_batcher.stats()
+        batches = Counter("write_batches_total", "insert_many calls made by the write batcher")
+        batches.inc(amount=stats["batches"])
+        documents = Counter("write_batched_documents_total", "Documents inserted through the write batcher")
+        documents.inc(amount=stats["documents"])
+        return [batches, documents]
+    return collect
+
+
+def log_pipeline_collector(log_pipeline):
+    """Returns a collector exposing the log records dropped by a LogPipeline"""
+    def collect():
+        dropped = Counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+        dropped.inc(amount=log_pipeline.dropped)
+        return [dropped]
+    return collect
+
+
+class CommandListener(monitoring.CommandListener):
+    """Times every command sent to MongoDB. The collection is only known by the started
+    event, so it is kept until the matching succeeded or failed event arrives"""
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = ""
+        self._pending[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event, outcome):
+        collection = self._pending.pop((event.connection_id, event.request_id), "")
+        mongodb_command_duration.observe(event.duration_micros / 1e6, collection, event.command_name, outcome)
+
+    def succeeded(self, event):
+        self._finish(event, "success")
+
+    def failed(self, event):
+        self._finish(event, "failure")
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """Tracks the checked out connections and how long threads wait to get one. The
+    check out events are published by the thread that asks for the connection"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        address = "{}:{}".format(*event.address)
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            mongodb_pool_wait.observe(time.perf_counter() - started, address)
+        mongodb_pool_checked_out.inc(address)
+
+    def connection_check_out_failed(self, event):
+        mongodb_pool_checkout_failures.inc("{}:{}".format(*event.address), str(event.reason))
+
+    def connection_checked_in(self, event):
+        mongodb_pool_checked_out.dec("{}:{}".format(*event.address))
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
@@ -0,0 +1,248 @@
+"""Opt-in tools to find out why a request is slow in production.
+
+RequestProfiler runs cProfile on the requests that send the PROFILE_TOKEN in the
+X-Profile-Token header, or on a PROFILE_SAMPLE_RATE fraction of them, and saves a pstats
+file per request in PROFILE_DIR, keeping only the last PROFILE_MAX_FILES.
+
+SlowRequestLog records the MongoDB commands of every request. When a request takes
+longer than SLOW_REQUEST_MS, a background thread explains its queries and logs them with
+a summary of their plans, so a COLLSCAN points at a missing index.
+"""
+import os
+import hmac
+import time
+import uuid
+import random
+import logging
+import cProfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.son import SON
+from flask import request
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+PROFILE_HEADER = "X-Profile-Token"
+# The commands that can be explained
+EXPLAINABLE_COMMANDS = ("find", "aggregate", "count", "distinct", "update", "delete", "findAndModify")
+# Fields of a command that explain does not accept
+SESSION_FIELDS = ("lsid", "txnNumber", "readConcern", "writeConcern")
+
+
+class RequestProfiler(object):
+
+    def __init__(self):
+        self.token = ""
+        self.sample_rate = 0.0
+        self.directory = "profiles"
+        self.max_files = 50
+        # cProfile can only run one profile at a time
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Adds the request hooks when PROFILE_TOKEN or PROFILE_SAMPLE_RATE is set"""
+        self.token = app.config['PROFILE_TOKEN']
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.directory = app.config['PROFILE_DIR']
+        self.max_files = app.config['PROFILE_MAX_FILES']
+        if self.token or self.sample_rate:
+            app.before_request(self.start)
+            app.after_request(self.stop)
+            app.teardown_request(self.discard)
+
+    def wanted(self):
+        token = request.headers.get(PROFILE_HEADER)
+        if token and self.token:
+            return hmac.compare_digest(token, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        """before_request hook. A request that should be profiled while another one is
+        being profiled is left alone"""
+        if not self.wanted() or not self._lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler, e.g. a debugger, is already running
+            self._lock.release()
+            return None
+        request.environ["profiling.profile"] = profile
+        return None
+
+    def stop(self, response):
+        """after_request hook. Saves the profile and names its file in X-Profile"""
+        profile = request.environ.pop("profiling.profile", None)
+        if profile is None:
+            return response
+        profile.disable()
+        self._lock.release()
+        response.headers["X-Profile"] = os.path.basename(self.save(profile))
+        return response
+
+    def discard(self, error=None):
+        """teardown_request hook, so the profiler stops even if after_request did not run"""
+        profile = request.environ.pop("profiling.profile", None)
+        if profile is not None:
+            profile.disable()
+            self._lock.release()
+
+    def save(self, profile):
+        """Writes the pstats file of the request and removes the oldest files beyond
+        max_files
+
+        :return: The path of the file
+        :rtype: str
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # The request id may come from the client, so the file is named with an id of our own
+        name = "{}-{}-{}.prof".format(time.strftime("%Y%m%dT%H%M%S"), request.endpoint or "unknown", uuid.uuid4().hex)
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path)
+        files = [os.path.join(self.directory, filename) for filename in os.listdir(self.directory)
+                 if filename.endswith(".prof")]
+        files.sort(key=os.path.getmtime)
+        for old in files[:-self.max_files]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        return path
+
+
+def filter_of(command_name: str, command: dict):
+    """Returns the filter of a command, or None if it has none"""
+    if command_name == "find":
+        return command.get("filter")
+    if command_name in ("count", "distinct", "findAndModify"):
+        return command.get("query")
+    if command_name == "aggregate":
+        for stage in command.get("pipeline", []):
+            if "$match" in stage:
+                return stage["$match"]
+        return None
+    statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+    return statements[0].get("q")
+
+
+def plan_summary(explain: dict):
+    """Returns the stages of the winning plans of an explain output, innermost first,
+    e.g. ["IXSCAN year_1", "FETCH"], and whether any of them scans the whole collection"""
+    stages = []
+
+    def add_stages(plan):
+        for child in plan.get("inputStages", []) + [plan.get("inputStage"), plan.get("queryPlan")]:
+            if isinstance(child, dict):
+                add_stages(child)
+        if "stage" in plan:
+            stages.append(plan["stage"] + (" " + plan["indexName"] if "indexName" in plan else ""))
+
+    def find_plans(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "winningPlan" and isinstance(value, dict):
+                    add_stages(value)
+                else:
+                    find_plans(value)
+        elif isinstance(node, list):
+            for value in node:
+                find_plans(value)
+
+    find_plans(explain)
+    return {"plan": stages, "collscan": "COLLSCAN" in stages}
+
+
+class SlowRequestLog(monitoring.CommandListener):
+    """Command listener that keeps the commands of the current request. PyMongo
+    publishes the events in the thread that runs the command, so a thread local is
+    enough to tell the requests apart"""
+
+    def __init__(self):
+        self.threshold = 0.0
+        self.max_commands = 100
+        self.mongo = None
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="explain")
+
+    def init_app(self, app, mongo):
+        """Adds the request hooks when SLOW_REQUEST_MS is set. The pool only starts its
+        thread on the first slow request, so it is safe to build before a fork
+
+        :param mongo: The MongoConnection used to run the explains
+        """
+        self.threshold = app.config['SLOW_REQUEST_MS'] / 1000
+        self.max_commands = app.config['SLOW_REQUEST_MAX_COMMANDS']
+        self.mongo = mongo
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="explain")
+        if self.threshold:
+            app.before_request(self.start)
+            app.teardown_request(self.finish)
+
+    def start(self):
+        self._local.commands = []
+        self._local.pending = {}
+        request.environ["slow_requests.started"] = time.perf_counter()
+
+    def started(self, event):
+        commands = getattr(self._local, "commands", None)
+        if commands is None or len(commands) >= self.max_commands:
+            return
+        command = event.command
+        collection = command.get(event.command_name)
+        entry = {"command": event.command_name, "collection": collection if isinstance(collection, str) else "",
+                 "database": event.database_name}
+        if event.command_name in EXPLAINABLE_COMMANDS:
+            query = filter_of(event.command_name, command)
+            entry["filter_fields"] = sorted(query) if isinstance(query, dict) else []
+            entry["explain"] = SON((key, value) for key, value in command.items()
+                                   if key not in SESSION_FIELDS and not key.startswith("$"))
+        commands.append(entry)
+        self._local.pending[event.request_id] = entry
+
+    def _finish_command(self, event):
+        pending = getattr(self._local, "pending", None)
+        entry = pending.pop(event.request_id, None) if pending is not None else None
+        if entry is not None:
+            entry["duration_ms"] = round(event.duration_micros / 1000, 3)
+
+    def succeeded(self, event):
+        self._finish_command(event)
+
+    def failed(self, event):
+        self._finish_command(event)
+
+    def finish(self, error=None):
+        """teardown_request hook. Hands the commands of a slow request to the explain
+        thread, so the request does not wait for the explains"""
+        commands = getattr(self._local, "commands", None)
+        self._local.commands = None
+        self._local.pending = None
+        started = request.environ.get("slow_requests.started")
+        if commands is None or started is None:
+            return
+        latency = time.perf_counter() - started
+        if latency < self.threshold:
+            return
+        details = {
+            "request_id": request.environ.get("log.request_id"),
+            "method": request.method,
+            "route": request.url_rule.rule if request.url_rule else None,
+            "latency_ms": round(latency * 1000, 3),
+        }
+        self._executor.submit(self.report, details, commands)
+
+    def report(self, details: dict, commands: list):
+        """Explains the queries of a slow request and logs them"""
+        for entry in commands:
+            database = entry.pop("database")
+            command = entry.pop("explain", None)
+            if command is None:
+                continue
+            try:
+                explain = self.mongo.client[database].command("explain", command, verbosity="queryPlanner")
+                entry.update(plan_summary(explain))
+            except PyMongoError as err:
+                entry["explain_error"] = str(err)
+        logging.getLogger("app.slow_requests").warning("slow request", extra=dict(details, commands=commands))
@@ -1,44 +1,442 @@
-from datetime import datetime
-
-from flask import render_template, flash, redirect, request, url_for, make_response, jsonify
-from flask_login import current_user, login_user, logout_user, login_required
-from werkzeug.urls import url_parse
-
-from app import app, db, logging
+from flask import Blueprint, current_app, request, make_response, Response
+
+from app.admission import exempt
+from app.bulk import insert_chunk
+from app.cascade import CLEAR
+from app.schemas import COLLECTION_SCHEMAS
+from app import (db, logging, schema_registry, document_cache, cascade_worker, read_coalescer, write_batcher,
+                 metrics, encoder, stats)
+from app.core import (headers, EXPANDABLE_FIELDS, InvalidRequest, make_message,
+                      document_entry, parse_expand, collection_fields, reference_fields, expanded_pipeline,
+                      merge_expanded, references_body, plan_listing, ndjson_line, page_body, split_ids, parse_ids,
+                      mget_query, mget_results, get_reference_ids, references_query, missing_references,
+                      reference_projection, prepare_restaurant, prepare_client)
 
 import json
-import jsonschema
-from jsonschema import validate
-from bson import json_util
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+bp = Blueprint("api", __name__)
 
-headers = {"Content-Type": "application/json"}
 
 def get_schema(filename: str):
-    """This function loads the given schema available"""
-    with open("app/"+filename, 'r') as file:
-        schema = json.load(file)
-    return schema
+    """This function returns the given schema available"""
+    return schema_registry.get(filename).schema
 
 
 def validate_json(dict_data: dict, schema_name: str):
     """REF: https://json-schema.org/ """
-    # Describe what kind of json you expect.
-    execute_api_schema = get_schema(schema_name)
+    # The validators are compiled once by the schema registry
+    return schema_registry.is_valid(dict_data, schema_name)
+
+def make_conditional_response(body: bytes, etag: str):
+    """Returns a 200 response with the given body and its precomputed ETag, so the
+    body is not hashed again by add_conditional_headers"""
+    response = make_response(body, 200, headers)
+    response.set_etag(etag)
+    return response
+
+
+def get_document_body(collection, id: str, projection: dict = None):
+    """Returns the serialized response body of one document, read through the
+    document cache. Concurrent misses of the same document share one query; the key of
+    the query holds the generation of the document, so a read that starts after a write
+    never joins a query that started before it. Only whole documents are cached; a
+    projection is always read from MongoDB
+
+    :param collection: The collection of the document
+    :param id: The id of the document
+    :param projection: The fields to be read, see get_fields
+    :raises bson.errors.InvalidId: If the id is not a valid ObjectId
+    :return: The body and its ETag, or None if the document does not exist
+    :rtype: tuple
+    """
+    object_id = ObjectId(id)
+    if projection:
+        generation = document_cache.generation(collection.name, str(object_id))
+        return read_coalescer.do((collection.name, str(object_id), generation, tuple(sorted(projection))),
+                                 lambda: load_document_body(collection, object_id, projection))
+    entry = document_cache.get(collection.name, str(object_id))
+    if entry is None:
+        generation = document_cache.generation(collection.name, str(object_id))
+        entry = read_coalescer.do((collection.name, str(object_id), generation),
+                                  lambda: load_document_body(collection, object_id, generation=generation))
+    return entry
+
+
+def load_document_body(collection, object_id: ObjectId, projection: dict = None, generation: int = None):
+    """Reads and serializes one document. Whole documents are cached unless they were
+    invalidated after generation, see DocumentCache"""
+    document = collection.find_one({"_id": object_id}, projection)
+    if not document:
+        return None
+    entry = document_entry(document)
+    if not projection:
+        document_cache.set(collection.name, str(object_id), entry, generation)
+    return entry
+
+
+def get_references_body(collection, id: str, field: str, projection: dict = None):
+    """Returns the serialized list of references held by a field of one document,
+    expanded with ?expand=. Concurrent identical reads of the same generation of the
+    document share one query
+
+    :param collection: The collection of the document
+    :param id: The id of the document
+    :param field: The list field, e.g. wines
+    :param projection: The fields of the expanded documents to be read, see get_fields.
+        Only used with ?expand=
+    :raises ValueError: If the expand parameter is not valid
+    :return: The body or None if the document does not exist
+    :rtype: bytes
+    """
+    object_id = ObjectId(id)
+    expand = get_expand(collection.name) == field
+
+    def load():
+        if expand:
+            document = find_expanded(collection, id, field, projection)
+        else:
+            document = collection.find_one({"_id": object_id}, {field: 1})
+        if not document:
+            return None
+        return references_body(document, field)
+    generation = document_cache.generation(collection.name, str(object_id))
+    return read_coalescer.do((collection.name, str(object_id), generation, field, expand, tuple(sorted(projection or ()))),
+                             load)
+
+
+def insert_document(collection, document: dict):
+    """Inserts one document and counts it in the stats. With WRITE_BATCHING on it is
+    written together with the inserts of concurrent requests
+
+    :raises DuplicateKeyError: If the name is already taken
+    """
+    if current_app.config["WRITE_BATCHING"]:
+        write_batcher.insert(collection, document)
+    else:
+        collection.insert_one(document)
+        stats.record(db, collection.name, after=document)
+
+
+def add_references(collection, id: str, field: str, reference_ids: list):
+    """Appends to a list field the references the document does not hold yet, with one
+    atomic $addToSet. Its pre-image tells how many references were added and the size
+    the list had, so the size stats follow this very write
+
+    :raises bson.errors.InvalidId: If the id is not a valid ObjectId
+    :return: The number of references added, or None if the document does not exist
+    :rtype: int
+    """
+    object_id = ObjectId(id)
+    reference_ids = list(dict.fromkeys(reference_ids))
+    previous = collection.find_one_and_update({"_id": object_id}, {"$addToSet": {field: {"$each": reference_ids}}},
+                                              reference_projection(field, reference_ids),
+                                              return_document=ReturnDocument.BEFORE)
+    document_cache.invalidate(collection.name, str(object_id))
+    if previous is None:
+        return None
+    added = len(reference_ids) - len(previous["held"])
+    if added:
+        stats.record_resized(db, collection.name, field, [previous["size"]], added)
+    return added
+
+
+def remove_reference(collection, id: str, field: str, reference_id: str):
+    """$pulls a reference from a list field, reading back the same pre-image as
+    add_references
+
+    :raises bson.errors.InvalidId: If the id is not a valid ObjectId
+    :return: The number of references removed, or None if the document does not exist
+    :rtype: int
+    """
+    object_id = ObjectId(id)
+    previous = collection.find_one_and_update({"_id": object_id}, {"$pull": {field: reference_id}},
+                                              reference_projection(field, [reference_id]),
+                                              return_document=ReturnDocument.BEFORE)
+    document_cache.invalidate(collection.name, str(object_id))
+    if previous is None:
+        return None
+    removed = len(previous["held"])
+    if removed:
+        stats.record_resized(db, collection.name, field, [previous["size"]], -removed)
+    return removed
+
+
+def find_missing(collection, reference_ids: list):
+    """Returns the ids of the list that do not exist in the collection, using one query"""
+    return missing_references(reference_ids, collection.find(references_query(reference_ids), {"_id": 1}))
+
+
+def get_expand(collection_name: str):
+    """Reads the ?expand= parameter of the request
+
+    :raises ValueError: If the field can not be expanded on the given collection
+    :return: The field to be expanded or None
+    :rtype: str
+    """
+    return parse_expand(request.args.get("expand"), collection_name)
+
+
+def get_fields(collection_name: str):
+    """Reads the ?fields= parameter of the request for the documents of the given collection
+
+    :raises InvalidRequest: If a field is unknown
+    """
+    return collection_fields(request.args.get("fields"), collection_name, get_schema(COLLECTION_SCHEMAS[collection_name]))
+
+
+def get_reference_fields(collection_name: str, field: str):
+    """Reads the ?fields= parameter of a read of the references of a document
+
+    :raises InvalidRequest: If a field is unknown or the references are not expanded
+    """
+    schema = get_schema(COLLECTION_SCHEMAS[EXPANDABLE_FIELDS[collection_name][field]])
+    return reference_fields(request.args, collection_name, field, schema)
+
+
+def find_expanded(collection, id: str, field: str, projection: dict = None):
+    """Returns one document with the given field expanded, in a single aggregation"""
+    for document in collection.aggregate(expanded_pipeline(collection.name, id, field, projection)):
+        return merge_expanded(document, field)
+    return None
+
 
+def wants_ndjson():
+    """Tells if the client asked for the NDJSON export mode, either with ?stream=1 or
+    with the header Accept: application/x-ndjson"""
+    if request.args.get("stream") in ("1", "true"):
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+
+def requested_ids():
+    """Returns the ids of a multi-get: ?ids=a,b,c or the ids array of a POST body"""
+    if request.method == "GET":
+        return split_ids(request.args.get("ids"))
+    body = request.get_json(silent=True)
+    return body.get("ids") if isinstance(body, dict) else body
+
+
+def multi_get(collection):
+    """Returns the documents of a list of ids read with one $in query, instead of one
+    request per document
+
+    :param collection: The collection of the documents
+    :return: The HTTP response
+    :rtype: Response with the result of every id and a HTTPStatus code
+    """
+    try:
+        requested = parse_ids(requested_ids(), current_app.config["MGET_MAX_IDS"])
+        projection = get_fields(collection.name)
+    except InvalidRequest as err:
+        return make_response(make_message(str(err)), 400, headers)
+    query = mget_query(requested)
+    documents = collection.find(query, projection) if query else []
+    return make_response(encoder.dumps({"body":mget_results(requested, documents)}), 200, headers)
+
+
+def list_documents(collection):
+    """Returns one page of the given collection sorted by _id, which is always indexed.
+    One extra document is read to know if there is a next page without a second query.
+    In NDJSON mode the whole collection (or up to ?limit=) is streamed instead.
+    With ?expand= the page is read with one aggregation that joins the related documents.
+    The filters of FILTER_FIELDS and RANGE_FIELDS narrow the listing, and ?q= turns it
+    into a text search sorted by relevance. ?fields= reads only the listed fields.
+    ?ids= reads those documents instead, see multi_get
+
+    :param collection: The collection to be listed
+    :return: The HTTP response
+    :rtype: Response with a body tag, the next cursor and a HTTPStatus code
+    """
+    if "ids" in request.args:
+        return multi_get(collection)
+    streaming = wants_ndjson()
     try:
-        validate(instance=dict_data, schema=execute_api_schema)
-    except jsonschema.exceptions.ValidationError as err:
-        return False
+        plan = plan_listing(collection.name, request.args, get_schema(COLLECTION_SCHEMAS[collection.name]), streaming,
+                            current_app.config["DEFAULT_PAGE_SIZE"], current_app.config["MAX_PAGE_SIZE"])
+    except InvalidRequest as err:
+        return make_response(make_message(str(err)), 400, headers)
+    if plan["pipeline"] is not None:
+        cursor = collection.aggregate(plan["pipeline"], batchSize=current_app.config["STREAM_BATCH_SIZE"])
+    else:
+        cursor = collection.find(plan["query"], plan["projection"]).sort("_id", ASCENDING) \
+            .batch_size(current_app.config["STREAM_BATCH_SIZE"])
+        if plan["limit"]:
+            cursor = cursor.limit(plan["limit"])
+    if streaming:
+        # The cursor is consumed by batches, so only one batch is held in memory at a time
+        return Response((ndjson_line(document, plan) for document in cursor), 200, mimetype="application/x-ndjson")
+    return make_response(page_body(list(cursor), plan), 200, headers)
+
+
+def read_bulk_items():
+    """Returns the items of a bulk request, either a JSON array or a NDJSON stream.
+    NDJSON lines are parsed while the body is read and the invalid ones become None
+
+    :return: An iterable over the items, or None if the body is not a JSON array
+    """
+    if request.mimetype == "application/x-ndjson":
+        def parse_lines():
+            for line in request.stream:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+        return parse_lines()
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return None
+    return items
+
+
+def bulk_create(collection, schema_name: str, prepare=None, check_chunk=None):
+    """Validates every item of a bulk request with the given schema and inserts the
+    valid ones in chunks of BULK_CHUNK_SIZE
+
+    :param collection: The collection where the documents are inserted
+    :param schema_name: The schema used to validate each item
+    :param prepare: Optional function that sets the default fields of a new document
+    :param check_chunk: Optional function that rejects documents of a chunk, see insert_chunk
+    :return: The HTTP response
+    :rtype: Response with the result of every item and a HTTPStatus code
+    """
+    items = read_bulk_items()
+    if items is None:
+        return make_response(make_message("Se esperaba un arreglo JSON o NDJSON"), 400, headers)
+    results = []
+    chunk = []
+    for index, item in enumerate(items):
+        if item is None or not validate_json(item, schema_name):
+            results.append({"index": index, "status": "invalid"})
+            continue
+        if prepare:
+            prepare(item)
+        chunk.append((index, item))
+        if len(chunk) >= current_app.config["BULK_CHUNK_SIZE"]:
+            results.extend(insert_chunk(collection, chunk, check_chunk))
+            chunk = []
+    if chunk:
+        results.extend(insert_chunk(collection, chunk, check_chunk))
+    results.sort(key=lambda result: result["index"])
+    summary = {status: 0 for status in ("created", "duplicate", "invalid", "error")}
+    for result in results:
+        summary[result["status"]] += 1
+    return make_response({"body":results, "summary":summary}, 200, headers)
+
+
+def check_managers(restaurants: list):
+    """Returns the positions of the restaurants whose manager is not a valid client"""
+    manager_ids = set()
+    rejected = set()
+    for position, restaurant in enumerate(restaurants):
+        if restaurant["manager_id"]:
+            try:
+                manager_ids.add(ObjectId(restaurant["manager_id"]))
+            except:
+                rejected.add(position)
+    if manager_ids:
+        existing_ids = {str(client["_id"]) for client in db.clients.find({"_id": {"$in": list(manager_ids)}}, {"_id": 1})}
+    else:
+        existing_ids = set()
+    for position, restaurant in enumerate(restaurants):
+        manager_id = restaurant["manager_id"]
+        if manager_id and position not in rejected and str(ObjectId(manager_id)) not in existing_ids:
+            rejected.add(position)
+    return rejected
+
+
+@bp.after_app_request
+def add_conditional_headers(response):
+    """Adds a strong ETag (a hash of the body) and Cache-Control to the successful reads
+    and answers 304 Not Modified when it matches the If-None-Match of the request"""
+    if request.method not in ("GET", "HEAD") or response.status_code != 200:
+        return response
+    if response.is_streamed or response.direct_passthrough:
+        return response
+    if not response.get_etag()[0]:
+        response.add_etag()
+    response.headers.setdefault("Cache-Control", current_app.config["CACHE_CONTROL"])
+    return response.make_conditional(request)
+
+
+@bp.route("/metrics", methods=["GET"])
+@exempt
+def prometheus_metrics():
+    """Function that exposes the metrics of this worker in the Prometheus text format
+
+    :return: The HTTP response
+    :rtype: Response with the metrics and a HTTPStatus code
+    """
+    return Response(metrics.registry.render(), 200, mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/cache/stats", methods=["GET"])
+@exempt
+def cache_stats():
+    """Function that returns the counters of the document cache of this worker
+
+    :return: The HTTP response
+    :rtype: Response with a body tag and a HTTPStatus code
+    """
+    return make_response({"body":document_cache.stats()}, 200, headers)
+
+
+@bp.route("/jobs/<string:job_id>", methods=["GET"])
+@exempt
+def cascade_job(job_id: str):
+    """Function that returns the status of a cascade cleanup job
+
+    :param job_id: The id returned by the DELETE that scheduled the job
+    :type job_id: str
+    :return: The HTTP response
+    :rtype: Response with a body tag and a HTTPStatus code
+    """
+    job = cascade_worker.status(db, job_id)
+    if job:
+        return make_response({"body":job}, 200, headers)
+    return make_response(make_message("Tarea no encontrada"), 404, headers)
+
+
+@bp.route("/stats", methods=["GET"])
+def list_stats():
+    """Function that lists the available catalog statistics
+
+    :return: The HTTP response
+    :rtype: Response with a body tag and a HTTPStatus code
+    """
+    available = ["{}/{}".format(collection_name, field)
+                 for collection_name, fields in stats.ROLLUPS.items() for field in fields]
+    return make_response({"body":available}, 200, headers)
+
 
-    return True
+@bp.route("/stats/<string:collection_name>/<string:field>", methods=["GET"])
+def read_stats(collection_name: str, field: str):
+    """Function that returns one catalog statistic, e.g. /stats/wines/country, read
+    from the stats collection that the write paths keep up to date
 
-def make_message(message:str):
-    return {"msg":message}
+    :param collection_name: The counted collection
+    :type collection_name: str
+    :param field: The field the documents are grouped by
+    :type field: str
+    :return: The HTTP response
+    :rtype: Response with a body tag, the total and a HTTPStatus code
+    """
+    if field not in stats.ROLLUPS.get(collection_name, {}):
+        return make_response(make_message("Estadística no encontrada"), 404, headers)
+    groups = stats.read(db, collection_name, field)
+    total = sum(group["count"] for group in groups)
+    return make_response(encoder.dumps({"body":groups, "total":total}), 200, headers)
 
 
-@app.route("/", methods=["GET", "POST"])
-@app.route("/index", methods=["GET", "POST"])
+@bp.route("/", methods=["GET", "POST"])
+@bp.route("/index", methods=["GET", "POST"])
+@exempt
 def index():
     """Función que redirecciona a la pagina principal
 
@@ -48,7 +446,7 @@ def index():
     return "Hola mundo"
 
 
-@app.route("/wines", methods=["GET", "POST"])
+@bp.route("/wines", methods=["GET", "POST"])
 def read_create_wines():
     """ Function that redirects to the read and create functions for the wines
 
@@ -56,24 +454,41 @@ def read_create_wines():
     :rtype: Response with a body tag and a HTTPStatus code
     """
     if request.method == "GET":
-        wines_cursor = db.wines.find()
-        body = [wine for wine in json.loads(json_util.dumps(wines_cursor))]
-        return make_response({"body":body}, 200, headers)
+        return list_documents(db.wines)
     elif request.method == "POST":
         dict_data = request.get_json()
         is_valid = validate_json(dict_data, "wine.json")
         if is_valid:
-            existing_wine = db.wines.find_one({"name":dict_data["name"]})
-            if not existing_wine:
-                db.wines.insert_one(dict_data)
-                return make_response(make_message("Agregado exitosamente"), 200, headers)
-            else:
+            try:
+                insert_document(db.wines, dict_data)
+            except DuplicateKeyError:
                 logging.warning("Attempted to write duplicated registry in wines collection")
                 return make_response(make_message("Registro duplicado"), 409, headers)
+            return make_response(make_message("Agregado exitosamente"), 200, headers)
         return make_response(make_message("Parámetros inválidos o faltantes"), 400, headers)
 
 
-@app.route("/wines/<string:id>", methods=["GET","PUT","PATCH","DELETE"])
+@bp.route("/wines/_mget", methods=["POST"])
+def mget_wines():
+    """ Function that reads many wines by id, sent as {"ids": [...]}. GET /wines?ids=a,b,c does the same
+
+    :return: The HTTP response
+    :rtype: Response with the result of every id and a HTTPStatus code
+    """
+    return multi_get(db.wines)
+
+
+@bp.route("/wines/bulk", methods=["POST"])
+def bulk_create_wines():
+    """ Function that creates many wines from a JSON array or a NDJSON stream
+
+    :return: The HTTP response
+    :rtype: Response with the result of every wine and a HTTPStatus code
+    """
+    return bulk_create(db.wines, "wine.json")
+
+
+@bp.route("/wines/<string:id>", methods=["GET","PUT","PATCH","DELETE"])
 def update_delete_wines(id: str):
     """ Function that redirects to the update and delete functions for the wines
 
@@ -84,9 +499,13 @@ def update_delete_wines(id: str):
     """
     if request.method == "GET":
         try:
-            selected_wine = db.wines.find_one({"_id": ObjectId(id)})
-            if selected_wine:
-                return make_response({"body":json.loads(json_util.dumps(selected_wine))},200,headers)
+            projection = get_fields("wines")
+        except InvalidRequest as err:
+            return make_response(make_message(str(err)), 400, headers)
+        try:
+            entry = get_document_body(db.wines, id, projection)
+            if entry:
+                return make_conditional_response(*entry)
             return make_response(make_message("Recurso no encontrado"),404, headers)
         except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
@@ -95,27 +514,33 @@ def update_delete_wines(id: str):
             dict_data = request.get_json()
             is_valid = validate_json(dict_data, "wine.json")
             if is_valid:
-                conflicting_wine = db.wines.find_one({"name":dict_data["name"]})
-                if conflicting_wine:
-                    return make_response(make_message("Conflcito entre registros. Otro vino ya tiene ese nombre"), 409, headers)
-                result = db.wines.replace_one({"_id": ObjectId(id)},dict_data)
-                if result.modified_count:
+                # The previous document tells which stats groups it leaves
+                previous = db.wines.find_one_and_replace({"_id": ObjectId(id)},dict_data)
+                document_cache.invalidate("wines", str(ObjectId(id)))
+                if previous:
+                    stats.record(db, "wines", previous, dict_data)
                     return make_response(make_message("Exitosamente actualizado"),200,headers)
                 return make_response(make_message("Vino no encontrado. Nada que actualizar"),404,headers)
             return make_response(make_message("Parámetros inválidos o faltantes"), 400, headers)
+        except DuplicateKeyError:
+            return make_response(make_message("Conflcito entre registros. Otro vino ya tiene ese nombre"), 409, headers)
         except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
     elif request.method == "DELETE":
         try:
-            result = db.wines.delete_one({"_id": ObjectId(id)})
-            if result.deleted_count:
-                return make_response(make_message("Exitosamente eliminado"),200,headers)
+            previous = db.wines.find_one_and_delete({"_id": ObjectId(id)})
+            document_cache.invalidate("wines", str(ObjectId(id)))
+            if previous:
+                stats.record(db, "wines", before=previous)
+                wine_id = str(ObjectId(id))
+                job_id = cascade_worker.enqueue(db.restaurants, "wines", wine_id)
+                return make_response(dict(make_message("Exitosamente eliminado"), job=job_id),200,headers)
             return make_response(make_message("No se hallo el vino. Nada que eliminar"),404, headers)
         except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
 
 
-@app.route("/restaurants", methods=["GET", "POST"])
+@bp.route("/restaurants", methods=["GET", "POST"])
 def read_create_restaurants():
     """Function that redirects to the create and read functions
 
@@ -123,34 +548,52 @@ def read_create_restaurants():
     :rtype: Response with a body tag and a HTTPStatus code
     """
     if request.method == "GET":
-        restaurants_cursor = db.restaurants.find()
-        body = [restaurant for restaurant in json.loads(json_util.dumps(restaurants_cursor))]
-        return make_response({"body":body}, 200, headers)
+        return list_documents(db.restaurants)
     elif request.method == "POST":
         dict_data = request.get_json()
         is_valid = validate_json(dict_data, "restaurant.json")
         if is_valid:
-            existing_restaurant = db.restaurants.find_one({"name":dict_data["name"]})
-            if not existing_restaurant:
-                dict_data["wines"]=[]
-                if dict_data.get("manager_id"):
-                    try:
-                        manager = db.clients.find_one({"_id":ObjectId(dict_data["manager_id"])})
-                    except:
-                        return make_response(make_message("Parametros invalidos o faltantes"), 400, headers)
-                    if not manager:
-                        return make_response(make_message("The manager doesn't exist"), 400, headers)
-                else:
-                    dict_data["manager_id"]=""
-                db.restaurants.insert_one(dict_data)
-                return make_response(make_message("Agregado exitosamente"), 200, headers)
+            dict_data["wines"]=[]
+            if dict_data.get("manager_id"):
+                try:
+                    manager = db.clients.find_one({"_id":ObjectId(dict_data["manager_id"])})
+                except:
+                    return make_response(make_message("Parametros invalidos o faltantes"), 400, headers)
+                if not manager:
+                    return make_response(make_message("The manager doesn't exist"), 400, headers)
             else:
+                dict_data["manager_id"]=""
+            try:
+                db.restaurants.insert_one(dict_data)
+            except DuplicateKeyError:
                 logging.warning("Attempted to write duplicated registry in restaurants collection")
                 return make_response(make_message("Registro duplicado"), 409, headers)
+            stats.record(db, "restaurants", after=dict_data)
+            return make_response(make_message("Agregado exitosamente"), 200, headers)
         return make_response(make_message("Parámetros inválidos o faltantes"), 400, headers)
 
 
-@app.route("/restaurants/<string:id>", methods=["GET","PUT","PATCH","DELETE"])
+@bp.route("/restaurants/_mget", methods=["POST"])
+def mget_restaurants():
+    """ Function that reads many restaurants by id, sent as {"ids": [...]}. GET /restaurants?ids=a,b,c does the same
+
+    :return: The HTTP response
+    :rtype: Response with the result of every id and a HTTPStatus code
+    """
+    return multi_get(db.restaurants)
+
+
+@bp.route("/restaurants/bulk", methods=["POST"])
+def bulk_create_restaurants():
+    """ Function that creates many restaurants from a JSON array or a NDJSON stream
+
+    :return: The HTTP response
+    :rtype: Response with the result of every restaurant and a HTTPStatus code
+    """
+    return bulk_create(db.restaurants, "restaurant.json", prepare_restaurant, check_managers)
+
+
+@bp.route("/restaurants/<string:id>", methods=["GET","PUT","PATCH","DELETE"])
 def update_delete_restaurants(id: str):
     """ Function that redirects to the update and delete actions
 
@@ -161,9 +604,13 @@ def update_delete_restaurants(id: str):
     """
     if request.method == "GET":
         try:
-            selected_restaurant = db.restaurants.find_one({"_id": ObjectId(id)})
-            if selected_restaurant:
-                return make_response({"body":json.loads(json_util.dumps(selected_restaurant))},200,headers)
+            projection = get_fields("restaurants")
+        except InvalidRequest as err:
+            return make_response(make_message(str(err)), 400, headers)
+        try:
+            entry = get_document_body(db.restaurants, id, projection)
+            if entry:
+                return make_conditional_response(*entry)
             return make_response(make_message("Recurso no encontrado"),404, headers)
         except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
@@ -172,9 +619,6 @@ def update_delete_restaurants(id: str):
             dict_data = request.get_json()
             is_valid = validate_json(dict_data, "restaurant.json")
             if is_valid:
-                conflicting_restaurant = db.restaurants.find_one({"name":dict_data["name"]})
-                if conflicting_restaurant:
-                    return make_response(make_message("Conflicto entre registros. Otro restaurante ya tiene ese nombre asignado"), 409, headers)
                 if dict_data.get("manager_id"):
                     manager = db.clients.find_one({"_id":ObjectId(dict_data["manager_id"])})
                     if not manager:
@@ -183,85 +627,82 @@ def update_delete_restaurants(id: str):
                     dict_data["manager_id"]=""
                 dict_data["wines"]=[]
 
-                result = db.restaurants.replace_one({"_id": ObjectId(id)},dict_data)
-                if result.modified_count:
+                # The previous document tells which stats groups it leaves
+                previous = db.restaurants.find_one_and_replace({"_id": ObjectId(id)},dict_data)
+                document_cache.invalidate("restaurants", str(ObjectId(id)))
+                if previous:
+                    stats.record(db, "restaurants", previous, dict_data)
                     return make_response(make_message("Actualizado exitosamente"),200,headers)
                 return make_response(make_message("El restaurante no fue hallado. Nada que actualizar"), 404, headers)
             return make_response(make_message("Parámetros inválidos o faltantes"), 400, headers)
+        except DuplicateKeyError:
+            return make_response(make_message("Conflicto entre registros. Otro restaurante ya tiene ese nombre asignado"), 409, headers)
         except:
             return make_response(make_message("No se pudo procesar la solicitud. Confirme que el id sea válido"), 400, headers)
     elif request.method == "DELETE":
         try:
-            result = db.restaurants.delete_one({"_id": ObjectId(id)})
-            if result.deleted_count:
-                return make_response(make_message("Eliminado exitosamente"),200,headers)
+            previous = db.restaurants.find_one_and_delete({"_id": ObjectId(id)})
+            document_cache.invalidate("restaurants", str(ObjectId(id)))
+            if previous:
+                stats.record(db, "restaurants", before=previous)
+                restaurant_id = str(ObjectId(id))
+                job_id = cascade_worker.enqueue(db.clients, "restaurants", restaurant_id)
+                return make_response(dict(make_message("Eliminado exitosamente"), job=job_id),200,headers)
             return make_response(make_message("No se hallo el restaurante. Nada que eliminar"),404, headers)
         except:
             return make_response(make_message("No se pudo procesar la solicitud"), 400, headers)
 
 
-@app.route("/restaurants/<string:id>/wines", methods=["GET","POST"])
+@bp.route("/restaurants/<string:id>/wines", methods=["GET","POST"])
 def wines_restaurants(id):
     if request.method == "GET":
         try:
-            selected_restaurant = db.restaurants.find_one({"_id": ObjectId(id)})
-            if selected_restaurant:
-                return make_response({"body":json.loads(json_util.dumps(selected_restaurant["wines"]))},200,headers)
+            projection = get_reference_fields("restaurants", "wines")
+        except InvalidRequest as err:
+            return make_response(make_message(str(err)), 400, headers)
+        try:
+            body = get_references_body(db.restaurants, id, "wines", projection)
+            if body:
+                return make_response(body,200,headers)
             return make_response(make_message("Restaurante no encontrado"),404, headers)
         except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
     elif request.method == "POST":
         try:
-            selected_restaurant = db.restaurants.find_one({"_id": ObjectId(id)})
-            if selected_restaurant:
-                dict_data = request.get_json()
-                is_valid = validate_json(dict_data, "add_wine.json")
-                if is_valid:
-                    existing_wine = db.wines.find_one({"_id": ObjectId(dict_data["wine_id"])})
-                    if existing_wine:
-                        wine_object_id = json.loads(json_util.dumps(existing_wine["_id"]))
-                        wine_id = wine_object_id["$oid"]
-                        if wine_id not in selected_restaurant["wines"]:
-                            selected_restaurant["wines"].append(wine_id)
-                        else:
-                            return make_response(make_message("Vino ya existente en restaurante"),409, headers)
-                        result = db.restaurants.replace_one({"_id": ObjectId(id)},selected_restaurant)
-                        if result.modified_count:
-                            return make_response(make_message("Actualizado exitosamente"),200,headers)
-                        return make_message(make_message("No se hallo el restaurante. Nada que actualizar"), 404, headers)
-                    else:
-                        return make_response(make_message("Could not add. Wine was not found"), 404, headers)      
+            dict_data = request.get_json()
+            is_valid = validate_json(dict_data, "add_wine.json")
+            if not is_valid:
                 return make_response(make_message("Parametros invalidos o faltantes"),400,headers)
-            return make_response(make_message("Restaurante no encontrado"),404, headers)
+            wine_ids = get_reference_ids(dict_data, "wine_id", "wine_ids")
+            missing_wines = find_missing(db.wines, wine_ids)
+            if missing_wines:
+                return make_response(dict(make_message("Could not add. Wine was not found"), missing=missing_wines), 404, headers)
+            added = add_references(db.restaurants, id, "wines", wine_ids)
+            if added is None:
+                return make_response(make_message("Restaurante no encontrado"),404, headers)
+            if added:
+                return make_response(make_message("Actualizado exitosamente"),200,headers)
+            return make_response(make_message("Vino ya existente en restaurante"),409, headers)
         except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
 
 
-@app.route("/restaurants/<string:restaurant_id>/wines/<string:wine_id>", methods=["DELETE"])
+@bp.route("/restaurants/<string:restaurant_id>/wines/<string:wine_id>", methods=["DELETE"])
 def delete_wine_from_restaurant(restaurant_id:str, wine_id:str):
     if request.method == "DELETE":
         try:
-            selected_restaurant = db.restaurants.find_one({"_id": ObjectId(restaurant_id)})
-            if selected_restaurant:
-                existing_wine = db.wines.find_one({"_id": ObjectId(wine_id)})
-                if existing_wine:
-                    if wine_id in selected_restaurant["wines"]:
-                        selected_restaurant["wines"].remove(wine_id)
-                        result = db.restaurants.replace_one({"_id": ObjectId(restaurant_id)},selected_restaurant)
-                        if result.modified_count:
-                            return make_response(make_message("Exitosamente actualizado"),200,headers)
-                        return make_response(make_message("No se hallo el restaurante. Nada que actualizar"), 404, headers)
-                    else:
-                        return make_response(make_message("Vino no fue hallado en el restaurante. Nada que hacer"), 404, headers)
-                else:
-                    return make_response(make_message("Vino no hallado en la BD"), 404, headers) 
-                return make_response()
-            return make_response(make_message("Recurso no encontrado"),404, headers)
+            wine_id = str(ObjectId(wine_id))
+            removed = remove_reference(db.restaurants, restaurant_id, "wines", wine_id)
+            if removed is None:
+                return make_response(make_message("Recurso no encontrado"),404, headers)
+            if removed:
+                return make_response(make_message("Exitosamente actualizado"),200,headers)
+            return make_response(make_message("Vino no fue hallado en el restaurante. Nada que hacer"), 404, headers)
         except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
 
 
-@app.route("/clients", methods=["GET", "POST"])
+@bp.route("/clients", methods=["GET", "POST"])
 def read_create_clients():
     """Function that redirects to the create and read functions
 
@@ -269,25 +710,42 @@ def read_create_clients():
     :rtype: Response with a body tag and a HTTPStatus code
     """
     if request.method == "GET":
-        clients_cursor = db.clients.find()
-        body = [client for client in json.loads(json_util.dumps(clients_cursor))]
-        return make_response({"body":body}, 200, headers)
+        return list_documents(db.clients)
     elif request.method == "POST":
         dict_data = request.get_json()
         is_valid = validate_json(dict_data, "client.json")
         if is_valid:
-            existing_client = db.clients.find_one({"name":dict_data["name"]})
-            if not existing_client:
-                dict_data["restaurants"]=[]
-                db.clients.insert_one(dict_data)
-                return make_response(make_message("Agregado exitosamente"), 200, headers)
-            else:
+            dict_data["restaurants"]=[]
+            try:
+                insert_document(db.clients, dict_data)
+            except DuplicateKeyError:
                 logging.warning("Attempted to write duplicated registry in client collection")
                 return make_response(make_message("Registro duplicado"), 409, headers)
+            return make_response(make_message("Agregado exitosamente"), 200, headers)
         return make_response(make_message("Parámetros inválidos o faltantes"), 400, headers)
 
 
-@app.route("/clients/<string:id>", methods=["GET","PUT","PATCH","DELETE"])
+@bp.route("/clients/_mget", methods=["POST"])
+def mget_clients():
+    """ Function that reads many clients by id, sent as {"ids": [...]}. GET /clients?ids=a,b,c does the same
+
+    :return: The HTTP response
+    :rtype: Response with the result of every id and a HTTPStatus code
+    """
+    return multi_get(db.clients)
+
+
+@bp.route("/clients/bulk", methods=["POST"])
+def bulk_create_clients():
+    """ Function that creates many clients from a JSON array or a NDJSON stream
+
+    :return: The HTTP response
+    :rtype: Response with the result of every client and a HTTPStatus code
+    """
+    return bulk_create(db.clients, "client.json", prepare_client)
+
+
+@bp.route("/clients/<string:id>", methods=["GET","PUT","PATCH","DELETE"])
 def update_delete_clients(id: str):
     """ Function that redirects to the update and delete actions
 
@@ -298,9 +756,13 @@ def update_delete_clients(id: str):
     """
     if request.method == "GET":
         try:
-            selected_client = db.clients.find_one({"_id": ObjectId(id)})
-            if selected_client:
-                return make_response({"body":json.loads(json_util.dumps(selected_client))},200,headers)
+            projection = get_fields("clients")
+        except InvalidRequest as err:
+            return make_response(make_message(str(err)), 400, headers)
+        try:
+            entry = get_document_body(db.clients, id, projection)
+            if entry:
+                return make_conditional_response(*entry)
             return make_response(make_message("Recurso no encontrado"),404, headers)
         except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
@@ -309,84 +771,77 @@ def update_delete_clients(id: str):
             dict_data = request.get_json()
             is_valid = validate_json(dict_data, "client.json")
             if is_valid:
-                conflicting_client = db.clients.find_one({"name":dict_data["name"]})
-                if conflicting_client:
-                    return make_response(make_message("Conflicto entre registros. Otro cliente ya tiene ese nombre asignado"), 409, headers)
                 dict_data["restaurants"]=[]
-                result = db.clients.replace_one({"_id": ObjectId(id)},dict_data)
-                if result.modified_count:
+                # The previous document tells which stats groups it leaves
+                previous = db.clients.find_one_and_replace({"_id": ObjectId(id)},dict_data)
+                document_cache.invalidate("clients", str(ObjectId(id)))
+                if previous:
+                    stats.record(db, "clients", previous, dict_data)
                     return make_response(make_message("Actualizado exitosamente"),200,headers)
                 return make_response(make_message("El restaurante no fue hallado. Nada que actualizar"), 404, headers)
             return make_response(make_message("Parámetros inválidos o faltantes"), 400, headers)
+        except DuplicateKeyError:
+            return make_response(make_message("Conflicto entre registros. Otro cliente ya tiene ese nombre asignado"), 409, headers)
         except:
             return make_response(make_message("No se pudo procesar la solicitud. Confirme que el id sea válido"), 400, headers)
     elif request.method == "DELETE":
         try:
-            result = db.clients.delete_one({"_id": ObjectId(id)})
-            if result.deleted_count:
-                return make_response(make_message("Eliminado exitosamente"),200,headers)
+            previous = db.clients.find_one_and_delete({"_id": ObjectId(id)})
+            document_cache.invalidate("clients", str(ObjectId(id)))
+            if previous:
+                stats.record(db, "clients", before=previous)
+                client_id = str(ObjectId(id))
+                job_id = cascade_worker.enqueue(db.restaurants, "manager_id", client_id, CLEAR)
+                return make_response(dict(make_message("Eliminado exitosamente"), job=job_id),200,headers)
             return make_response(make_message("No se hallo el cliente. Nada que eliminar"),404, headers)
         except:
             return make_response(make_message("No se pudo procesar la solicitud"), 400, headers)
 
 
-@app.route("/clients/<string:id>/restaurants", methods=["GET","POST"])
+@bp.route("/clients/<string:id>/restaurants", methods=["GET","POST"])
 def clients_restaurants(id):
     if request.method == "GET":
         try:
-            selected_client = db.clients.find_one({"_id": ObjectId(id)})
-            if selected_client:
-                return make_response({"body":json.loads(json_util.dumps(selected_client["restaurants"]))},200,headers)
+            projection = get_reference_fields("clients", "restaurants")
+        except InvalidRequest as err:
+            return make_response(make_message(str(err)), 400, headers)
+        try:
+            body = get_references_body(db.clients, id, "restaurants", projection)
+            if body:
+                return make_response(body,200,headers)
             return make_response(make_message("Restaurante no encontrado"),404, headers)
         except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
     elif request.method == "POST":
         try:
-            selected_client = db.clients.find_one({"_id": ObjectId(id)})
-            if selected_client:
-                dict_data = request.get_json()
-                is_valid = validate_json(dict_data, "add_restaurant.json")
-                if is_valid:
-                    existing_restaurant = db.restaurants.find_one({"_id": ObjectId(dict_data["restaurant_id"])})
-                    if existing_restaurant:
-                        restaurant_object_id = json.loads(json_util.dumps(existing_restaurant["_id"]))
-                        restaurant_id = restaurant_object_id["$oid"]
-                        if restaurant_id not in selected_client["restaurants"]:
-                            selected_client["restaurants"].append(restaurant_id)
-                        else:
-                            return make_response(make_message("Restaurante ya existente para el cliente"),409, headers)
-                        result = db.clients.replace_one({"_id": ObjectId(id)},selected_client)
-                        print(result.raw_result)
-                        if result.modified_count:
-                            return make_response(make_message("Actualizado exitosamente"),200,headers)
-                        return make_response(make_message("No se hallo el cliente. Nada que actualizar"), 404, headers)
-                    else:
-                        return make_response(make_message("Could not add. Wine was not found"), 404, headers)      
+            dict_data = request.get_json()
+            is_valid = validate_json(dict_data, "add_restaurant.json")
+            if not is_valid:
                 return make_response(make_message("Parametros invalidos o faltantes"),400,headers)
-            return make_response(make_message("Restaurante no encontrado"),404, headers)
-        except ZeroDivisionError as e:
+            restaurant_ids = get_reference_ids(dict_data, "restaurant_id", "restaurant_ids")
+            missing_restaurants = find_missing(db.restaurants, restaurant_ids)
+            if missing_restaurants:
+                return make_response(dict(make_message("Could not add. Restaurant was not found"), missing=missing_restaurants), 404, headers)
+            added = add_references(db.clients, id, "restaurants", restaurant_ids)
+            if added is None:
+                return make_response(make_message("Cliente no encontrado"),404, headers)
+            if added:
+                return make_response(make_message("Actualizado exitosamente"),200,headers)
+            return make_response(make_message("Restaurante ya existente para el cliente"),409, headers)
+        except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que el id sea válido"), 400, headers)
 
 
-@app.route("/clients/<string:client_id>/restaurants/<string:restaurant_id>", methods=["DELETE"])
+@bp.route("/clients/<string:client_id>/restaurants/<string:restaurant_id>", methods=["DELETE"])
 def delete_restaurant_from_client(client_id:str, restaurant_id:str):
     if request.method == "DELETE":
         try:
-            selected_client = db.clients.find_one({"_id": ObjectId(client_id)})
-            if selected_client:
-                existing_restaurant = db.restaurants.find_one({"_id": ObjectId(restaurant_id)})
-                if existing_restaurant:
-                    if restaurant_id in selected_client["restaurants"]:
-                        selected_client["restaurants"].remove(restaurant_id)
-                        result = db.clients.replace_one({"_id": ObjectId(client_id)},selected_client)
-                        if result.modified_count:
-                            return make_response(make_message("Exitosamente actualizado"),200,headers)
-                        return make_response(make_message("No se hallo el cliente. Nada que actualizar"), 404, headers)
-                    else:
-                        return make_response(make_message("Restaurante no fue hallado en el cliente. Nada que hacer"), 404, headers)
-                else:
-                    return make_response(make_message("Restaurante no hallado en la BD"), 404, headers) 
-                return make_response()
-            return make_response(make_message("Recurso no encontrado"),404, headers)
-        except ZeroDivisionError as e:
+            restaurant_id = str(ObjectId(restaurant_id))
+            removed = remove_reference(db.clients, client_id, "restaurants", restaurant_id)
+            if removed is None:
+                return make_response(make_message("Recurso no encontrado"),404, headers)
+            if removed:
+                return make_response(make_message("Exitosamente actualizado"),200,headers)
+            return make_response(make_message("Restaurante no fue hallado en el cliente. Nada que hacer"), 404, headers)
+        except:
             return make_response(make_message("No se pudo procesar la solcitud. Confirme que los id's sean válido"), 400, headers)
@@ -0,0 +1,60 @@
+import os
+import json
+import threading
+
+from jsonschema import Draft4Validator
+
+SCHEMA_DIR = os.path.dirname(os.path.abspath(__file__))
+# The schema file of the documents of every collection
+COLLECTION_SCHEMAS = {"wines": "wine.json", "restaurants": "restaurant.json", "clients": "client.json"}
+
+
+class SchemaRegistry(object):
+    """Keeps one compiled Draft4Validator per schema file of the app folder.
+
+    Schemas are parsed and checked only once. When auto_reload is on (useful while
+    developing) the file modification time is compared on every lookup and the
+    validator is rebuilt if the file changed.
+    """
+
+    def __init__(self, schema_dir: str = SCHEMA_DIR, auto_reload: bool = False):
+        self.schema_dir = schema_dir
+        self.auto_reload = auto_reload
+        self._validators = {}
+        self._lock = threading.Lock()
+
+    def _load(self, filename: str):
+        path = os.path.join(self.schema_dir, filename)
+        mtime = os.path.getmtime(path)
+        with open(path, 'r') as file:
+            schema = json.load(file)
+        Draft4Validator.check_schema(schema)
+        entry = (Draft4Validator(schema), mtime)
+        with self._lock:
+            self._validators[filename] = entry
+        return entry
+
+    def get(self, filename: str):
+        """Returns the compiled validator of the given schema file
+
+        :param filename: Name of the schema file inside the schema folder, e.g. wine.json
+        :type filename: str
+        :return: The validator of the schema
+        :rtype: Draft4Validator
+        """
+        entry = self._validators.get(filename)
+        if entry is None:
+            entry = self._load(filename)
+        elif self.auto_reload:
+            if os.path.getmtime(os.path.join(self.schema_dir, filename)) != entry[1]:
+                entry = self._load(filename)
+        return entry[0]
+
+    def preload(self):
+        """Compiles every schema file of the schema folder"""
+        for filename in sorted(os.listdir(self.schema_dir)):
+            if filename.endswith(".json"):
+                self._load(filename)
+
+    def is_valid(self, instance, filename: str):
+        return self.get(filename).is_valid(instance)
@@ -0,0 +1,73 @@
+import threading
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces identical concurrent reads of a worker.
+
+    The first thread asking for a key runs the read; the threads asking for the same key
+    while it runs wait for it and get the same result, or the same exception. A waiting
+    thread gives up after timeout seconds and runs the read by itself. Nothing is kept
+    once the read finishes; caching is the job of the DocumentCache. The callers put the
+    generation of the document (see DocumentCache.generation) in the key, so a write
+    ends the current flight: the reads that arrive after it start a new query instead
+    of getting the result of one that may have started before the write.
+    """
+
+    def __init__(self, timeout: float = 2.0):
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def init_app(self, app):
+        self.timeout = app.config['SINGLEFLIGHT_TIMEOUT']
+
+    def do(self, key, function):
+        """Returns the result of function(), sharing it with the concurrent calls of the
+        same key
+
+        :param key: Hashable identity of the read, e.g. ("wines", id)
+        :param function: The read, without arguments
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+        if leader:
+            try:
+                call.result = function()
+                return call.result
+            except Exception as err:
+                call.error = err
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        if not call.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+                self.executed += 1
+            return function()
+        with self._lock:
+            self.shared += 1
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {"executed": self.executed, "shared": self.shared, "timeouts": self.timeouts,
+                    "in_flight": len(self._calls)}
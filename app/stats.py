@@ -0,0 +1,155 @@
+"""Catalog statistics kept in the stats collection.
+
+Every statistic counts the documents of a collection by one group key: the value of a
+field (wines by country, type and year) or the size of a list of references (wines per
+restaurant, restaurants per client). Each group is one document
+
+    {"collection": "wines", "field": "country", "key": "Chile", "count": 42}
+
+that the write paths keep up to date with $inc, so reading a statistic only touches
+its groups. `flask stats rebuild` recomputes the whole collection from scratch in case
+the counts drifted, e.g. after writes made outside the API.
+"""
+import logging
+from collections import Counter
+
+import click
+from flask.cli import AppGroup
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from app.indexes import INDEXES
+
+VALUE = "value"
+SIZE = "size"
+
+# The statistics of every collection, by field, and whether the group key is the value
+# of the field or the size of the list it holds
+ROLLUPS = {
+    "wines": {"country": VALUE, "type": VALUE, "year": VALUE},
+    "restaurants": {"wines": SIZE},
+    "clients": {"restaurants": SIZE},
+}
+
+
+def group_key(document: dict, field: str, kind: str):
+    value = document.get(field)
+    if kind == SIZE:
+        return len(value) if isinstance(value, list) else 0
+    return value
+
+
+def changes(collection_name: str, before: dict = None, after: dict = None):
+    """Returns how the counts of the groups change when a document goes from before to
+    after. None stands for a document that did not exist (a create) or no longer
+    exists (a delete)
+
+    :rtype: Counter
+    """
+    delta = Counter()
+    for field, kind in ROLLUPS.get(collection_name, {}).items():
+        if before is not None:
+            delta[(field, group_key(before, field, kind))] -= 1
+        if after is not None:
+            delta[(field, group_key(after, field, kind))] += 1
+    return delta
+
+
+def updates(collection_name: str, delta: Counter):
+    """Returns the upserts that apply the changes to the stats collection"""
+    return [UpdateOne({"collection": collection_name, "field": field, "key": key},
+                      {"$inc": {"count": count}}, upsert=True)
+            for (field, key), count in delta.items() if count]
+
+
+def apply(db, collection_name: str, delta: Counter):
+    """Writes the changes with one bulk_write. A failure is only logged, since the
+    document write already succeeded; the rebuild command repairs the counts"""
+    operations = updates(collection_name, delta)
+    if not operations:
+        return
+    try:
+        db.stats.bulk_write(operations, ordered=False)
+    except PyMongoError as err:
+        logging.error("Could not update the stats of the %s collection: %s", collection_name, err)
+
+
+def record(db, collection_name: str, before: dict = None, after: dict = None):
+    """Updates the stats after a document was created, replaced, updated or deleted"""
+    apply(db, collection_name, changes(collection_name, before, after))
+
+
+def record_created(db, collection_name: str, documents: list):
+    """Updates the stats after many documents were created"""
+    delta = Counter()
+    for document in documents:
+        delta.update(changes(collection_name, after=document))
+    apply(db, collection_name, delta)
+
+
+def resize_changes(field: str, sizes: list, change: int):
+    """Returns how the size groups change when documents whose lists held the given
+    sizes gain change references, or lose them if change is negative
+
+    :rtype: Counter
+    """
+    delta = Counter()
+    for size in sizes:
+        delta[(field, size)] -= 1
+        delta[(field, size + change)] += 1
+    return delta
+
+
+def record_resized(db, collection_name: str, field: str, sizes: list, change: int):
+    """Updates the size stats of documents whose lists held the given sizes before a
+    write changed them by change references. The sizes come from the pre-image of that
+    write, so concurrent writes to the same document each move it one step"""
+    apply(db, collection_name, resize_changes(field, sizes, change))
+
+
+def record_pulled(db, collection_name: str, field: str, sizes: list):
+    """Updates the size stats of documents that lost one reference to a $pull of the
+    cascade cleanup, given the sizes their lists had before it. References are unique,
+    so each list held the pulled id once"""
+    record_resized(db, collection_name, field, sizes, -1)
+
+
+def read(db, collection_name: str, field: str):
+    """Returns the groups of a statistic sorted by key, leaving out the empty ones"""
+    cursor = db.stats.find({"collection": collection_name, "field": field, "count": {"$gt": 0}},
+                           {"_id": 0, "key": 1, "count": 1}).sort("key")
+    return list(cursor)
+
+
+def rebuild(db):
+    """Recomputes every statistic with one $group per field into a new collection,
+    which then replaces the stats collection at once. Increments made by requests
+    while it runs are lost, so it is meant for a quiet moment
+
+    :return: The number of groups written
+    :rtype: int
+    """
+    groups = []
+    for collection_name, fields in ROLLUPS.items():
+        for field, kind in fields.items():
+            key = "$" + field if kind == VALUE else {"$size": {"$ifNull": ["$" + field, []]}}
+            for group in db[collection_name].aggregate([{"$group": {"_id": key, "count": {"$sum": 1}}}]):
+                groups.append({"collection": collection_name, "field": field,
+                               "key": group["_id"], "count": group["count"]})
+    staging = db.stats_rebuild
+    staging.drop()
+    staging.create_indexes(INDEXES["stats"])
+    if groups:
+        staging.insert_many(groups)
+    staging.rename("stats", dropTarget=True)
+    return len(groups)
+
+
+stats_cli = AppGroup("stats", help="Catalog statistics")
+
+
+@stats_cli.command("rebuild")
+def rebuild_command():
+    """Recomputes the stats collection from the wines, restaurants and clients"""
+    from app import db
+    click.echo("Rebuilt {} groups".format(rebuild(db)))
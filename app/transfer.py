@@ -0,0 +1,311 @@
+"""Import and export of whole collections from the command line.
+
+    flask import wines wines.ndjson
+    flask export clients clients.csv
+
+Files are NDJSON, one extended JSON document per line like the NDJSON export of the
+API, or CSV with a header row. Both commands work by chunks and, after each one, save a
+checkpoint next to the file (FILE.progress) with the byte offset reached. Running the
+same command again after an interruption continues from there; --restart ignores it.
+"""
+import os
+import csv
+import io
+import json
+
+import click
+from bson import json_util
+from bson.objectid import ObjectId
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import ASCENDING
+
+from app import encoder
+from app.bulk import insert_chunk
+from app.schemas import COLLECTION_SCHEMAS
+
+# Fields the API sets on new documents, filled in when an imported document lacks them
+DEFAULTS = {"restaurants": {"wines": list, "manager_id": str}, "clients": {"restaurants": list}}
+FORMATS = ("ndjson", "csv")
+STATUSES = ("created", "duplicate", "invalid", "error")
+
+
+class LineReader(object):
+    """Iterates over the lines of a binary file as text, keeping the offset of the end
+    of the last line read, which is where the next run has to continue"""
+
+    def __init__(self, file):
+        self.file = file
+        self.offset = file.tell()
+
+    def seek(self, offset: int):
+        self.file.seek(offset)
+        self.offset = offset
+
+    def __iter__(self):
+        for line in self.file:
+            self.offset += len(line)
+            yield line.decode("utf-8")
+
+
+def guess_format(path: str):
+    return "csv" if path.lower().endswith(".csv") else "ndjson"
+
+
+def checkpoint_path(path: str):
+    return path + ".progress"
+
+
+def read_checkpoint(path: str, collection_name: str, file_format: str):
+    """Returns the checkpoint of an interrupted run over the file, or None"""
+    try:
+        with open(checkpoint_path(path), "r") as file:
+            checkpoint = json.load(file)
+    except FileNotFoundError:
+        return None
+    if checkpoint["collection"] != collection_name or checkpoint["format"] != file_format:
+        raise click.ClickException("{} belongs to a run over {} ({}); use --restart to ignore it".format(
+            checkpoint_path(path), checkpoint["collection"], checkpoint["format"]))
+    return checkpoint
+
+
+def write_checkpoint(path: str, checkpoint: dict):
+    """Replaces the checkpoint at once, so an interruption never leaves half of it"""
+    temporary = checkpoint_path(path) + ".tmp"
+    with open(temporary, "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(temporary, checkpoint_path(path))
+
+
+def remove_checkpoint(path: str):
+    if os.path.exists(checkpoint_path(path)):
+        os.remove(checkpoint_path(path))
+
+
+def csv_columns(collection_name: str, schema: dict):
+    """Returns the CSV columns of a collection: the _id, the fields of its schema and its
+    lists of references"""
+    columns = ["_id"] + list(schema.get("properties", {}))
+    return columns + [field for field in DEFAULTS.get(collection_name, {}) if field not in columns]
+
+
+def to_csv_row(document: dict, columns: list):
+    """Returns the cells of a document. Lists and objects are written as extended JSON"""
+    row = []
+    for column in columns:
+        value = document.get(column)
+        if value is None:
+            value = ""
+        elif isinstance(value, ObjectId):
+            value = str(value)
+        elif isinstance(value, (list, dict)):
+            value = encoder.dumps(value).decode()
+        row.append(value)
+    return row
+
+
+def from_csv_row(row: dict, schema: dict):
+    """Rebuilds a document from a CSV row: empty cells are left out, the fields the
+    schema declares as numbers are converted and the extended JSON cells are parsed
+
+    :return: The document, or None if a cell could not be converted
+    :rtype: dict
+    """
+    properties = schema.get("properties", {})
+    document = {}
+    for column, value in row.items():
+        if column is None or value is None or value == "":
+            continue
+        kind = properties.get(column, {}).get("type")
+        try:
+            if column == "_id" and ObjectId.is_valid(value):
+                value = ObjectId(value)
+            elif kind == "integer" or (kind == "number" and value.lstrip("-").isdigit()):
+                value = int(value)
+            elif kind == "number":
+                value = float(value)
+            elif kind is None and value[0] in "[{":
+                value = json_util.loads(value)
+        except ValueError:
+            return None
+        document[column] = value
+    return document
+
+
+def read_records(lines: LineReader, file_format: str, schema: dict, columns: list = None):
+    """Yields every record of the file as a document, or None if it can not be parsed,
+    with the offset where the record ends"""
+    if file_format == "csv":
+        for row in csv.reader(lines):
+            if len(row) != len(columns):
+                yield None, lines.offset
+            else:
+                yield from_csv_row(dict(zip(columns, row)), schema), lines.offset
+        return
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            document = json_util.loads(line)
+        except ValueError:
+            document = None
+        yield (document if isinstance(document, dict) else None), lines.offset
+
+
+def import_file(collection, path: str, file_format: str, chunk_size: int, resume: bool = True, on_progress=None):
+    """Validates every record of the file with the schema of the collection and inserts
+    the valid ones with one unordered insert_many per chunk. The manager of a
+    restaurant is not checked, so the collections can be imported in any order.
+    Documents that keep the _id of an export are reported as duplicate if they were
+    already imported
+
+    :param collection: The collection where the documents are inserted
+    :param path: The NDJSON or CSV file
+    :param file_format: ndjson or csv
+    :param chunk_size: Documents per insert_many
+    :param resume: Continue from the checkpoint of an interrupted run, if any
+    :param on_progress: Optional function called with the offset reached in the file
+    :return: How many records were created, duplicate, invalid or failed
+    :rtype: dict
+    """
+    from app import schema_registry
+    validator = schema_registry.get(COLLECTION_SCHEMAS[collection.name])
+    checkpoint = read_checkpoint(path, collection.name, file_format) if resume else None
+    summary = checkpoint["summary"] if checkpoint else {status: 0 for status in STATUSES}
+    defaults = DEFAULTS.get(collection.name, {})
+
+    def flush(chunk, offset):
+        for result in insert_chunk(collection, chunk):
+            summary[result["status"]] += 1
+        write_checkpoint(path, {"collection": collection.name, "format": file_format,
+                                "offset": offset, "summary": summary})
+        if on_progress:
+            on_progress(offset)
+
+    with open(path, "rb") as file:
+        lines = LineReader(file)
+        columns = None
+        if file_format == "csv":
+            columns = next(csv.reader(lines), [])
+        if checkpoint:
+            lines.seek(checkpoint["offset"])
+        if on_progress:
+            on_progress(lines.offset)
+        chunk = []
+        offset = lines.offset
+        for document, offset in read_records(lines, file_format, validator.schema, columns):
+            if document is None or not validator.is_valid(document):
+                summary["invalid"] += 1
+                continue
+            for field, default in defaults.items():
+                document.setdefault(field, default())
+            chunk.append((len(chunk), document))
+            if len(chunk) >= chunk_size:
+                flush(chunk, offset)
+                chunk = []
+        flush(chunk, offset)
+    remove_checkpoint(path)
+    return summary
+
+
+def export_file(collection, path: str, file_format: str, batch_size: int, resume: bool = True, on_progress=None):
+    """Writes every document of the collection to the file, reading them sorted by _id
+    with a cursor of batch_size documents, so only one batch is in memory at a time. An
+    interrupted export is cut back to its last complete batch and continues after the
+    last _id written
+
+    :param collection: The collection to export
+    :param path: The NDJSON or CSV file
+    :param file_format: ndjson or csv
+    :param batch_size: Documents per cursor batch and per write
+    :param resume: Continue from the checkpoint of an interrupted run, if any
+    :param on_progress: Optional function called with the number of documents written
+    :return: The number of documents written
+    :rtype: int
+    """
+    from app import schema_registry
+    checkpoint = read_checkpoint(path, collection.name, file_format) if resume else None
+    columns = csv_columns(collection.name, schema_registry.get(COLLECTION_SCHEMAS[collection.name]).schema)
+    query = {}
+    written = 0
+    if checkpoint:
+        query = {"_id": {"$gt": json_util.loads(checkpoint["last_id"])}}
+        written = checkpoint["documents"]
+
+    def write(file, batch):
+        if file_format == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(to_csv_row(document, columns) for document in batch)
+            file.write(buffer.getvalue().encode("utf-8"))
+        else:
+            file.write(b"".join(encoder.dumps(document) + b"\n" for document in batch))
+        file.flush()
+        write_checkpoint(path, {"collection": collection.name, "format": file_format, "offset": file.tell(),
+                                "last_id": json_util.dumps(batch[-1]["_id"]), "documents": written})
+        if on_progress:
+            on_progress(written)
+
+    with open(path, "r+b" if checkpoint else "wb") as file:
+        if checkpoint:
+            file.truncate(checkpoint["offset"])
+            file.seek(checkpoint["offset"])
+        elif file_format == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow(columns)
+            file.write(buffer.getvalue().encode("utf-8"))
+        batch = []
+        for document in collection.find(query).sort("_id", ASCENDING).batch_size(batch_size):
+            batch.append(document)
+            if len(batch) >= batch_size:
+                written += len(batch)
+                write(file, batch)
+                batch = []
+        if batch:
+            written += len(batch)
+            write(file, batch)
+    remove_checkpoint(path)
+    return written
+
+
+def progress_callback(bar):
+    """Adapts a click progress bar to the absolute positions reported by the imports
+    and exports"""
+    def on_progress(position):
+        bar.update(position - bar.pos)
+    return on_progress
+
+
+@click.command("import")
+@click.argument("collection_name", type=click.Choice(sorted(COLLECTION_SCHEMAS)))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(FORMATS), help="By default, guessed from the extension")
+@click.option("--chunk-size", type=int, help="Documents per insert_many, BULK_CHUNK_SIZE by default")
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint of an interrupted import")
+@with_appcontext
+def import_command(collection_name, path, file_format, chunk_size, restart):
+    """Imports a NDJSON or CSV file into a collection"""
+    from app import db
+    file_format = file_format or guess_format(path)
+    chunk_size = chunk_size or current_app.config['BULK_CHUNK_SIZE']
+    with click.progressbar(length=os.path.getsize(path), label="Importing {}".format(collection_name)) as bar:
+        summary = import_file(db[collection_name], path, file_format, chunk_size, not restart, progress_callback(bar))
+    click.echo(", ".join("{} {}".format(summary[status], status) for status in STATUSES))
+
+
+@click.command("export")
+@click.argument("collection_name", type=click.Choice(sorted(COLLECTION_SCHEMAS)))
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(FORMATS), help="By default, guessed from the extension")
+@click.option("--batch-size", type=int, help="Documents per cursor batch, STREAM_BATCH_SIZE by default")
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint of an interrupted export")
+@with_appcontext
+def export_command(collection_name, path, file_format, batch_size, restart):
+    """Exports a collection to a NDJSON or CSV file"""
+    from app import db
+    file_format = file_format or guess_format(path)
+    batch_size = batch_size or current_app.config['STREAM_BATCH_SIZE']
+    collection = db[collection_name]
+    with click.progressbar(length=collection.estimated_document_count(),
+                           label="Exporting {}".format(collection_name)) as bar:
+        written = export_file(collection, path, file_format, batch_size, not restart, progress_callback(bar))
+    click.echo("Exported {} documents".format(written))
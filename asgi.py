@@ -0,0 +1 @@
+from app.aio import app
@@ -0,0 +1,54 @@
+"""Compares two reports written by benchmarks/run.py.
+
+    $ python benchmarks/compare.py baseline.json candidate.json --threshold 10
+
+Prints the change of every scenario and exits with status 1 when the p95 latency grew,
+or the throughput dropped, by more than the threshold (in percent).
+"""
+import sys
+import json
+import argparse
+
+
+def change(before, after):
+    if not before:
+        return None
+    return (after - before) / before * 100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    args = parser.parse_args()
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.candidate) as file:
+        candidate = json.load(file)
+
+    print("baseline  {}".format(baseline["meta"].get("commit")))
+    print("candidate {}".format(candidate["meta"].get("commit")))
+    print("{:<28} {:<12} {:>10} {:>10} {:>9} {:>12} {:>12} {:>9}".format(
+        "scenario", "driver", "p95 before", "p95 after", "change", "rps before", "rps after", "change"))
+    regressions = []
+    for scenario, drivers in sorted(candidate["results"].items()):
+        for driver, result in sorted(drivers.items()):
+            previous = baseline["results"].get(scenario, {}).get(driver)
+            if not previous:
+                continue
+            latency_change = change(previous["p95_ms"], result["p95_ms"])
+            throughput_change = change(previous["throughput_rps"], result["throughput_rps"])
+            print("{:<28} {:<12} {:>10.3f} {:>10.3f} {:>8.1f}% {:>12.1f} {:>12.1f} {:>8.1f}%".format(
+                scenario, driver, previous["p95_ms"], result["p95_ms"], latency_change or 0,
+                previous["throughput_rps"], result["throughput_rps"], throughput_change or 0))
+            if (latency_change or 0) > args.threshold or (throughput_change or 0) < -args.threshold:
+                regressions.append("{} ({})".format(scenario, driver))
+    if regressions:
+        print("\nRegressions over {}%: {}".format(args.threshold, ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
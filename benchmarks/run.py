@@ -0,0 +1,380 @@
+"""HTTP and data-layer benchmark suite of the CRUD API.
+
+Seeds the database with generated wines, restaurants and clients, then drives every
+scenario through the Flask test client (no network, measures the app and the data
+layer) and through a real threaded WSGI server over HTTP at the given concurrency.
+For each scenario it reports p50/p95/p99 latency, throughput, errors and the peak RSS
+of the process, and writes everything to a JSON file that benchmarks/compare.py can
+compare across commits. Admission control and rate limiting are turned off unless
+--admission is given; requests they turn away (503 and 429) are counted as rejected,
+not as errors, e.g. when driving a server with --url.
+
+    $ python benchmarks/run.py --mongo-uri mongodb://127.0.0.1:27017/wineadvisor_bench
+    $ python benchmarks/run.py --in-process --wines 20000 --output bench.json
+
+WARNING: the target database is dropped and seeded again. Never point it to real data.
+--in-process uses mongomock as a stand-in for mongod (pip install mongomock).
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import resource
+import itertools
+import threading
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+COUNTRIES = ["Chile", "Argentina", "France", "Italy", "Spain", "Mexico", "USA", "Portugal"]
+# Answers of admission control and rate limiting, reported apart from the errors
+REJECTED_STATUSES = (429, 503)
+# The last wines are never in a seeded restaurant and the last restaurants never in a
+# seeded client; restaurant_wine_add_remove and client_restaurant_add_remove link them
+RELATIONSHIP_WINES = 64
+RELATIONSHIP_RESTAURANTS = 64
+GRAPES = ["Cabernet", "Merlot", "Malbec", "Syrah", "Tempranillo", "Chardonnay", "Pinot Noir"]
+
+
+def load_app(args):
+    """Imports the Flask app, pointing it to the benchmark database"""
+    os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ.setdefault("LOG_TO_STDOUT", "1")
+    if not args.admission:
+        for setting in ("ADMISSION_READS", "ADMISSION_WRITES", "ADMISSION_BULK", "RATE_LIMIT"):
+            os.environ[setting] = "0"
+    from app import create_app
+    from app import routes
+    app = create_app()
+    if args.in_process:
+        import mongomock
+        database = mongomock.MongoClient().db
+        import app as package
+        package.db = database
+        routes.db = database
+    return app, routes.db
+
+
+def seed(db, args):
+    """Drops the collections and inserts the generated documents"""
+    generator = random.Random(args.seed)
+    for name in ("wines", "restaurants", "clients"):
+        db[name].drop()
+    from app.indexes import ensure_indexes
+    ensure_indexes(db)
+
+    wines = [{"name": "Wine {}".format(i), "year": generator.randint(1950, 2021),
+              "type": generator.choice(GRAPES), "country": generator.choice(COUNTRIES)}
+             for i in range(args.wines)]
+    for start in range(0, len(wines), 5000):
+        db.wines.insert_many(wines[start:start + 5000], ordered=False)
+    wine_ids = [str(wine["_id"]) for wine in wines]
+    menu_ids = wine_ids[:-RELATIONSHIP_WINES] or wine_ids
+
+    restaurants = [{"name": "Restaurant {}".format(i), "address": "Street {}".format(i), "manager_id": "",
+                    "wines": generator.sample(menu_ids, min(len(menu_ids), args.wines_per_restaurant))}
+                   for i in range(args.restaurants)]
+    for start in range(0, len(restaurants), 5000):
+        db.restaurants.insert_many(restaurants[start:start + 5000], ordered=False)
+    restaurant_ids = [str(restaurant["_id"]) for restaurant in restaurants]
+    listed_ids = restaurant_ids[:-RELATIONSHIP_RESTAURANTS] or restaurant_ids
+
+    clients = [{"name": "Client {}".format(i), "email": "client{}@example.com".format(i),
+                "telephone": "55{:08d}".format(i),
+                "restaurants": generator.sample(listed_ids, min(len(listed_ids), 3))}
+               for i in range(args.clients)]
+    for start in range(0, len(clients), 5000):
+        db.clients.insert_many(clients[start:start + 5000], ordered=False)
+    return {"wines": wine_ids, "restaurants": restaurant_ids,
+            "clients": [str(client["_id"]) for client in clients]}
+
+
+def build_scenarios(ids, args):
+    """Returns, by scenario name, a function that gives the (method, path, body) of the
+    i-th request. Write scenarios use a run prefix so repeated drivers do not collide.
+    Scenarios run in order, so the ones that replace or delete seeded documents come last"""
+    generator = random.Random(args.seed)
+    hot_wines = ids["wines"][:max(1, len(ids["wines"]) // 100)]
+    middle_wine = sorted(ids["wines"])[len(ids["wines"]) // 2]
+
+    def wine(prefix, i):
+        return {"name": "{} {}".format(prefix, i), "year": 2000 + i % 20,
+                "type": GRAPES[i % len(GRAPES)], "country": COUNTRIES[i % len(COUNTRIES)]}
+
+    # Every worker thread gets its own documents, so concurrent requests never race on
+    # one of them and every answer is a 200
+    workers = threading.local()
+    slots = itertools.count()
+
+    def worker_step(scenario):
+        """Returns the slot of the calling worker thread and how many requests of the
+        scenario it already sent"""
+        if not hasattr(workers, "slot"):
+            workers.slot = next(slots)
+            workers.steps = {}
+        step = workers.steps.get(scenario, 0)
+        workers.steps[scenario] = step + 1
+        return workers.slot, step
+
+    linked = {}
+
+    def relationship(scenario, parents, children, reserved, field):
+        """Links and unlinks, alternating, a pair of documents of the worker. The child is
+        one of the last reserved ones, which the seeded parents never hold"""
+        slot, _ = worker_step(scenario)
+        parent = ids[parents][slot % len(ids[parents])]
+        child = ids[children][-1 - slot % min(reserved, len(ids[children]))]
+        linked[parent, child] = not linked.get((parent, child), False)
+        if linked[parent, child]:
+            return "POST", "/{}/{}/{}".format(parents, parent, children), {field: child}
+        return "DELETE", "/{}/{}/{}/{}".format(parents, parent, children, child), None
+
+    def seeded(collection_name, index, i):
+        """The body that replaces a seeded document, keeping its unique name"""
+        if collection_name == "wines":
+            return dict(wine("Wine", i), name="Wine {}".format(index))
+        if collection_name == "restaurants":
+            return {"name": "Restaurant {}".format(index), "address": "Avenue {}".format(i)}
+        return {"name": "Client {}".format(index), "email": "client{}@example.com".format(index),
+                "telephone": "55{:08d}".format(i)}
+
+    def update_read(collection_name, method):
+        """Replaces the document of the worker and reads it back, alternating, so every
+        read follows an invalidation of the document cache"""
+        def scenario(run, i):
+            slot, step = worker_step("update_" + collection_name)
+            index = slot % len(ids[collection_name])
+            path = "/{}/{}".format(collection_name, ids[collection_name][index])
+            if step % 2:
+                return "GET", path, None
+            return method, path, seeded(collection_name, index, i)
+        return scenario
+
+    def delete(collection_name):
+        """Deletes every seeded document once, in order, across the drivers. Deleting a
+        wine, restaurant or client starts a cascade job over the documents that hold it"""
+        victims = itertools.count()
+
+        def scenario(run, i):
+            return "DELETE", "/{}/{}".format(collection_name, ids[collection_name][
+                next(victims) % len(ids[collection_name])]), None
+        return scenario
+
+    return {
+        "list_wines_first_page": lambda run, i: ("GET", "/wines", None),
+        "list_wines_deep_page": lambda run, i: ("GET", "/wines?limit=100&after=" + middle_wine, None),
+        "list_restaurants": lambda run, i: ("GET", "/restaurants", None),
+        "list_clients": lambda run, i: ("GET", "/clients", None),
+        "get_wine_hot": lambda run, i: ("GET", "/wines/" + hot_wines[i % len(hot_wines)], None),
+        "get_wine_random": lambda run, i: ("GET", "/wines/" + generator.choice(ids["wines"]), None),
+        "get_restaurant": lambda run, i: ("GET", "/restaurants/" + ids["restaurants"][i % len(ids["restaurants"])], None),
+        "get_client": lambda run, i: ("GET", "/clients/" + ids["clients"][i % len(ids["clients"])], None),
+        "get_restaurant_wines": lambda run, i: (
+            "GET", "/restaurants/{}/wines".format(ids["restaurants"][i % len(ids["restaurants"])]), None),
+        "get_client_restaurants": lambda run, i: (
+            "GET", "/clients/{}/restaurants".format(ids["clients"][i % len(ids["clients"])]), None),
+        "write_burst_wines": lambda run, i: ("POST", "/wines", wine("Burst " + run, i)),
+        "write_burst_wines_bulk": lambda run, i: (
+            "POST", "/wines/bulk", [wine("Bulk {} {}".format(run, i), j) for j in range(args.bulk_size)]),
+        "create_restaurants": lambda run, i: (
+            "POST", "/restaurants", {"name": "Burst {} {}".format(run, i), "address": "Street {}".format(i)}),
+        "create_clients": lambda run, i: (
+            "POST", "/clients", {"name": "Burst {} {}".format(run, i), "email": "burst{}@example.com".format(i),
+                                 "telephone": "55{:08d}".format(i)}),
+        "restaurant_wine_add_remove": lambda run, i: relationship(
+            "restaurant_wine", "restaurants", "wines", RELATIONSHIP_WINES, "wine_id"),
+        "client_restaurant_add_remove": lambda run, i: relationship(
+            "client_restaurant", "clients", "restaurants", RELATIONSHIP_RESTAURANTS, "restaurant_id"),
+        "update_get_wine": update_read("wines", "PUT"),
+        "update_get_restaurant": update_read("restaurants", "PATCH"),
+        "update_get_client": update_read("clients", "PUT"),
+        "delete_clients": delete("clients"),
+        "delete_restaurants": delete("restaurants"),
+        "delete_wines": delete("wines"),
+    }
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return usage // 1024 if sys.platform == "darwin" else usage
+
+
+def summarize(latencies, statuses, elapsed):
+    rejected = sum(1 for status in statuses if status in REJECTED_STATUSES)
+    errors = sum(1 for status in statuses if status >= 500 and status not in REJECTED_STATUSES)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rejected": rejected,
+        "statuses": {str(status): statuses.count(status) for status in sorted(set(statuses))},
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def drive(send, scenario, run, requests, concurrency):
+    """Sends the requests of a scenario from a pool of threads"""
+    latencies = [0.0] * requests
+    statuses = [0] * requests
+
+    def work(i):
+        method, path, body = scenario(run, i)
+        started = time.perf_counter()
+        statuses[i] = send(method, path, body)
+        latencies[i] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(work, range(requests)))
+    return summarize(latencies, statuses, time.perf_counter() - started)
+
+
+def test_client_sender(app):
+    local = threading.local()
+
+    def send(method, path, body):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        response = local.client.open(path, method=method, json=body)
+        response.get_data()
+        # Like a WSGI server, so the callbacks of the response (e.g. the release of the
+        # admission slot) run
+        response.close()
+        return response.status_code
+    return send
+
+
+def http_sender(host, port):
+    local = threading.local()
+
+    def send(method, path, body):
+        payload = json.dumps(body).encode() if body is not None else None
+        for attempt in range(2):
+            if not hasattr(local, "connection"):
+                local.connection = http.client.HTTPConnection(host, port, timeout=60)
+            try:
+                local.connection.request(method, path, body=payload, headers={"Content-Type": "application/json"})
+                response = local.connection.getresponse()
+                response.read()
+                if response.getheader("Connection", "").lower() == "close" or response.version == 10:
+                    local.connection.close()
+                    del local.connection
+                return response.status
+            except (http.client.HTTPException, OSError):
+                local.connection.close()
+                del local.connection
+                if attempt:
+                    raise
+    return send
+
+
+def start_wsgi_server(app):
+    from werkzeug.serving import make_server
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, port
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default=os.environ.get("BENCH_MONGO_URI", "mongodb://127.0.0.1:27017/wineadvisor_bench"))
+    parser.add_argument("--in-process", action="store_true", help="Use mongomock instead of a mongod")
+    parser.add_argument("--url", help="Drive an already running server (e.g. gunicorn) instead of starting one")
+    parser.add_argument("--drivers", default="test_client,wsgi", help="Comma separated: test_client, wsgi")
+    parser.add_argument("--scenarios", help="Comma separated subset of the scenarios")
+    parser.add_argument("--wines", type=int, default=10000)
+    parser.add_argument("--restaurants", type=int, default=1000)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--wines-per-restaurant", type=int, default=50)
+    parser.add_argument("--bulk-size", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=500, help="Requests per scenario and driver")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--admission", action="store_true",
+                        help="Keep the ADMISSION_* and RATE_LIMIT settings of the environment")
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    app, db = load_app(args)
+    started = time.perf_counter()
+    ids = seed(db, args)
+    print("Seeded {} wines, {} restaurants and {} clients in {:.1f}s".format(
+        args.wines, args.restaurants, args.clients, time.perf_counter() - started))
+
+    scenarios = build_scenarios(ids, args)
+    if args.scenarios:
+        scenarios = {name: scenarios[name] for name in args.scenarios.split(",")}
+
+    senders = {}
+    server = None
+    for driver in args.drivers.split(","):
+        if driver == "test_client":
+            senders[driver] = test_client_sender(app)
+        elif driver == "wsgi":
+            if args.url:
+                target = http.client.urlsplit(args.url)
+                senders[driver] = http_sender(target.hostname, target.port or 80)
+            else:
+                server, port = start_wsgi_server(app)
+                senders[driver] = http_sender("127.0.0.1", port)
+        else:
+            parser.error("Unknown driver {}".format(driver))
+
+    results = {}
+    for name, scenario in scenarios.items():
+        results[name] = {}
+        for driver, send in senders.items():
+            results[name][driver] = drive(send, scenario, driver, args.requests, args.concurrency)
+            result = results[name][driver]
+            print("{:<28} {:<12} p50 {:>9.3f}ms  p95 {:>9.3f}ms  p99 {:>9.3f}ms  {:>9.1f} req/s  errors {}  rejected {}".format(
+                name, driver, result["p50_ms"], result["p95_ms"], result["p99_ms"], result["throughput_rps"],
+                result["errors"], result["rejected"]))
+    if server:
+        server.shutdown()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": "mongomock" if args.in_process else "mongod",
+            "args": {key: value for key, value in vars(args).items() if key != "mongo_uri"},
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+    print("Results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
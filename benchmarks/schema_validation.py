@@ -0,0 +1,68 @@
+"""Microbenchmark of the JSON Schema validation done on every POST/PUT/PATCH.
+
+Compares the previous approach (open and parse the schema file, then call
+jsonschema.validate, which builds a new validator) against the compiled
+validators kept by app.schemas.SchemaRegistry.
+
+    $ python benchmarks/schema_validation.py --iterations 20000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import jsonschema
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.schemas import SchemaRegistry, SCHEMA_DIR  # noqa: E402
+
+SAMPLES = {
+    "wine.json": {"name": "Casillero del Diablo", "year": 2018, "type": "Cabernet", "country": "Chile"},
+    "restaurant.json": {"name": "Pujol", "address": "Tennyson 133, CDMX"},
+    "client.json": {"name": "Ana", "email": "ana@example.com", "telephone": "5555555555"},
+}
+
+
+def per_request_load(instance, schema_name):
+    with open(os.path.join(SCHEMA_DIR, schema_name), 'r') as file:
+        schema = json.load(file)
+    try:
+        jsonschema.validate(instance=instance, schema=schema)
+    except jsonschema.exceptions.ValidationError:
+        return False
+    return True
+
+
+def measure(function, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for schema_name, instance in SAMPLES.items():
+            function(instance, schema_name)
+    elapsed = time.perf_counter() - start
+    return iterations * len(SAMPLES) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    registry = SchemaRegistry()
+    registry.preload()
+    reloading_registry = SchemaRegistry(auto_reload=True)
+
+    results = {
+        "per_request_load": measure(per_request_load, args.iterations),
+        "registry": measure(lambda instance, name: registry.is_valid(instance, name), args.iterations),
+        "registry_auto_reload": measure(lambda instance, name: reloading_registry.is_valid(instance, name),
+                                        args.iterations),
+    }
+    baseline = results["per_request_load"]
+    for name, rate in results.items():
+        print("{:<22} {:>12,.0f} validations/s  ({:.1f}x)".format(name, rate, rate / baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Measures the cold start of the app: the time to import handler.py (which builds the
+app) and the resident memory of the process right after it, in fresh interpreters.
+
+    $ python benchmarks/startup.py --runs 10
+    $ python benchmarks/startup.py --root /path/to/another/checkout
+
+Nothing connects to MongoDB during the import, so no server is needed.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROBE = """
+import sys, time, json
+started = time.perf_counter()
+import handler
+elapsed = time.perf_counter() - started
+with open("/proc/self/status") as file:
+    rss = [line for line in file if line.startswith("VmRSS:")]
+print(json.dumps({
+    "import_s": elapsed,
+    "rss_kb": int(rss[0].split()[1]) if rss else None,
+    "modules": len(sys.modules),
+    "heavy": sorted(name for name in ("pandas", "numpy", "flask_migrate", "flask_login", "flask_bootstrap")
+                    if name in sys.modules),
+}))
+"""
+
+
+def measure(root):
+    env = dict(os.environ, LOG_TO_STDOUT="1")
+    output = subprocess.check_output([sys.executable, "-c", PROBE], cwd=root, env=env, stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default=ROOT, help="Checkout to measure")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    samples = [measure(args.root) for _ in range(args.runs)]
+    print("import handler  median {:.3f}s  min {:.3f}s".format(
+        statistics.median(sample["import_s"] for sample in samples), min(sample["import_s"] for sample in samples)))
+    print("rss after start median {:.1f} MB".format(statistics.median(sample["rss_kb"] for sample in samples) / 1024))
+    print("modules loaded  {}".format(samples[-1]["modules"]))
+    print("heavy modules   {}".format(", ".join(samples[-1]["heavy"]) or "none"))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,3 +6,64 @@ class Config(object):
     MONGO_URI = os.environ.get('MONGO_URI') or \
         'mongodb://127.0.0.1:27017/wineadvisor'
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    # Records waiting to be written; past this they are dropped instead of blocking a request
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE') or 10000)
+    # Fraction of the INFO events (e.g. one per request) that are written
+    LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE') or 1)
+    # Requests sending this value in the X-Profile-Token header are profiled with cProfile
+    PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN') or ''
+    # Fraction of all the requests that are profiled
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or 'profiles'
+    PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES') or 50)
+    # Requests slower than this log their MongoDB commands with their query plans; 0 turns it off
+    SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS') or 0)
+    SLOW_REQUEST_MAX_COMMANDS = int(os.environ.get('SLOW_REQUEST_MAX_COMMANDS') or 100)
+    # Comma separated, e.g. login,bootstrap. The JSON API needs none of them
+    OPTIONAL_EXTENSIONS = (os.environ.get('OPTIONAL_EXTENSIONS') or '').split(',')
+    DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE') or 50)
+    MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE') or 500)
+    # Most ids a single ?ids= or _mget request may ask for
+    MGET_MAX_IDS = int(os.environ.get('MGET_MAX_IDS') or 100)
+    STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE') or 1000)
+    SCHEMA_AUTO_RELOAD = os.environ.get('SCHEMA_AUTO_RELOAD')
+    BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE') or 1000)
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES') or 10000)
+    CACHE_TTL = float(os.environ.get('CACHE_TTL') or 60)
+    CACHE_CONTROL = os.environ.get('CACHE_CONTROL') or 'private, no-cache'
+    # Seconds a read waits for an identical read already running before running its own
+    SINGLEFLIGHT_TIMEOUT = float(os.environ.get('SINGLEFLIGHT_TIMEOUT') or 2)
+    CASCADE_WORKERS = int(os.environ.get('CASCADE_WORKERS') or 2)
+    CASCADE_BATCH_SIZE = int(os.environ.get('CASCADE_BATCH_SIZE') or 500)
+    CASCADE_MAX_RETRIES = int(os.environ.get('CASCADE_MAX_RETRIES') or 5)
+    CASCADE_JOB_LEASE = float(os.environ.get('CASCADE_JOB_LEASE') or 30)
+    CASCADE_JOB_TTL = int(os.environ.get('CASCADE_JOB_TTL') or 86400)
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 1024)
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)
+    # Bytes of a streamed response compressed between two flushes to the client
+    COMPRESS_FLUSH_SIZE = int(os.environ.get('COMPRESS_FLUSH_SIZE') or 65536)
+    # Threads of every gunicorn worker, i.e. the most requests a worker runs at once
+    GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS') or 8)
+    # Requests of each class running at once in a worker (0 means no limit), how many
+    # more may wait for a slot and for how long before getting a 503. A waiting request
+    # holds a thread, so a limit plus the waiting ones must stay below GUNICORN_THREADS
+    ADMISSION_READS = int(os.environ.get('ADMISSION_READS') or max(1, GUNICORN_THREADS // 2))
+    ADMISSION_WRITES = int(os.environ.get('ADMISSION_WRITES') or max(1, GUNICORN_THREADS // 4))
+    ADMISSION_BULK = int(os.environ.get('ADMISSION_BULK') or max(1, GUNICORN_THREADS // 4))
+    ADMISSION_MAX_WAITING = int(os.environ.get('ADMISSION_MAX_WAITING') or GUNICORN_THREADS // 4)
+    ADMISSION_WAIT_TIMEOUT = float(os.environ.get('ADMISSION_WAIT_TIMEOUT') or 0.5)
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER') or 1)
+    # Requests per second allowed to each client (0 means no limit) and the burst
+    RATE_LIMIT = float(os.environ.get('RATE_LIMIT') or 0)
+    RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST') or 20)
+    # Header identifying the client, e.g. X-Api-Key. The remote address is used otherwise
+    RATE_LIMIT_HEADER = os.environ.get('RATE_LIMIT_HEADER')
+    # Opt-in: single POST /wines and POST /clients inserts of concurrent requests are
+    # written together, waiting up to WRITE_BATCH_MAX_WAIT_MS or WRITE_BATCH_MAX_SIZE documents
+    WRITE_BATCHING = os.environ.get('WRITE_BATCHING')
+    WRITE_BATCH_MAX_WAIT_MS = float(os.environ.get('WRITE_BATCH_MAX_WAIT_MS') or 5)
+    WRITE_BATCH_MAX_SIZE = int(os.environ.get('WRITE_BATCH_MAX_SIZE') or 500)
+    # Seconds a request waits for the batch it joined before failing
+    WRITE_BATCH_TIMEOUT = float(os.environ.get('WRITE_BATCH_TIMEOUT') or 10)
@@ -0,0 +1,28 @@
+# Loaded by gunicorn from the working directory, e.g.
+#   gunicorn --preload -w 4 handler:app
+from config import Config
+
+# Threaded workers. The admission limits, the read coalescing and the write batching
+# all work inside one worker process: with the default sync workers each process runs
+# a single request at a time, so the limits would never be reached and there would be
+# nothing to coalesce or batch.
+worker_class = "gthread"
+threads = Config.GUNICORN_THREADS
+
+
+def on_starting(server):
+    """Refuses to start with an admission limit that can not be reached. A worker runs
+    at most threads requests at once and queues the rest without any bound, so a class
+    only gets its 503s if its limit plus the waiting requests leave a thread free"""
+    for setting in ("ADMISSION_READS", "ADMISSION_WRITES", "ADMISSION_BULK"):
+        limit = getattr(Config, setting)
+        if limit and limit + Config.ADMISSION_MAX_WAITING >= server.cfg.threads:
+            raise RuntimeError("{} ({}) plus ADMISSION_MAX_WAITING ({}) must be lower than the {} threads of "
+                               "a worker".format(setting, limit, Config.ADMISSION_MAX_WAITING, server.cfg.threads))
+
+
+def post_worker_init(worker):
+    """Warms up the MongoDB client of every worker before it accepts requests. The
+    client is created here, after the fork, and never in the --preload master"""
+    from app import warm_up
+    warm_up()
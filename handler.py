@@ -1,5 +1,10 @@
-from app import app, db
+from app import create_app, db
+from app.transfer import import_command, export_command
+
+app = create_app()
+app.cli.add_command(import_command)
+app.cli.add_command(export_command)
 
 @app.shell_context_processor
 def make_shell_context():
-    return {'db': db}
\ No newline at end of file
+    return {'db': db}